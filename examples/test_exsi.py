@@ -40,7 +40,7 @@ def main():
     exsi_instance.sendScan()
     print('Localizer scan started')
 
-    exsi_instance.images_ready_event.wait()
+    exsi_instance.wait_images_ready()
     print('Localizer scan done')
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import pydicom
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 class Orientation(Enum):
@@ -11,7 +12,9 @@ class Orientation(Enum):
 def listSubDirs(directory):
     # Function to list all DICOM files in a directory
     if os.path.exists(directory):
-        subdirs = [os.path.join(directory, d) for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
+        # scandir already knows the entry types, so no extra stat per entry
+        with os.scandir(directory) as entries:
+            subdirs = [entry.path for entry in entries if entry.is_dir()]
         subdirs.sort(key=lambda f: int(f.split('/')[-1][1:]))
         return subdirs
     else:
@@ -67,28 +70,33 @@ def extractMetadata(dcm):
         print(f"Error extracting metadata: {e}")
         return None, None
 
+def readPixelVolume(paths, workers=8):
+    # Read the pixel data of every dicom file into one preallocated (numFiles, rows, cols) volume
+    # the first file sizes the volume, the rest are read by a small thread pool since the reads are mostly file I/O
+    first = pydicom.dcmread(paths[0])
+    volume = np.empty((len(paths), *first.pixel_array.shape), dtype=first.pixel_array.dtype)
+    volume[0] = first.pixel_array
+
+    def readSlice(i):
+        volume[i] = pydicom.dcmread(paths[i]).pixel_array
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # consume the results so any read error is raised here
+        for _ in pool.map(readSlice, range(1, len(paths))):
+            pass
+    return volume, first
+
 def extractComplexImageData(dcmSeriesPath, threshFactor=.5):
     # NOTE: Assumes that Mag, I, Q images are interleaved in the series!!!
     # Process a dicom directory and pulls out masked complex data
     paths = listDicomFiles(dcmSeriesPath)
     if paths is None:
         raise Exception("No Scans Exist Yet In the Local Directory...")
-    mags = []
-    Is = []
-    Qs = []
-    te = None
-    for i in range(0, len(paths), 3):
-        mag = pydicom.dcmread(paths[i])
-        I = pydicom.dcmread(paths[i+1])
-        Q = pydicom.dcmread(paths[i+2])
-        mags.append(mag.pixel_array)
-        Is.append(I.pixel_array)
-        Qs.append(Q.pixel_array)
-        if te is None:
-            te, name = extractMetadata(mag)
-    mags = np.stack(mags, axis=0)
-    Is = np.stack(Is, axis=0)
-    Qs = np.stack(Qs, axis=0)
+    paths = paths[:len(paths) // 3 * 3] # only complete mag, I, Q triplets
+    mags, magDcm = readPixelVolume(paths[0::3])
+    Is, _ = readPixelVolume(paths[1::3])
+    Qs, _ = readPixelVolume(paths[2::3])
+    te, name = extractMetadata(magDcm)
     phase = Is + 1j*Qs
 
     thresh = np.mean(mags) * threshFactor
@@ -102,12 +110,6 @@ def extractBasicImageData(dcmSeriesPath, stride=1, offset=0):
     paths = listDicomFiles(dcmSeriesPath)
     if paths is None:
         raise Exception("No Scans Exist Yet In the Local Directory...")
-    data3d = []
-    te = None
-    for i in range(0, len(paths), stride):
-        data = pydicom.dcmread(paths[i+offset])
-        data3d.append(data.pixel_array)
-        te, orientation = extractMetadata(data)
-    data3d = np.stack(data3d, axis=0)
+    data3d, dcm = readPixelVolume(paths[offset::stride])
+    te, orientation = extractMetadata(dcm)
     return data3d, te, orientation
-
@@ -1,13 +1,51 @@
+import os
 import socket
+import selectors
 import struct
 import threading
 import queue
 import re
+from collections import deque
 from datetime import datetime
 
+# a SelectTask queued without its task number, i.e. it looks like 'taskkey='
+SELECT_TASK_PATTERN = re.compile(r"SelectTask taskkey=(?!\d+)")
+# "channel current" of the calibration command suffix, "cmd | channel current"
+CURRENT_PATTERN = re.compile(r"(\d+)\s(\d+\.\d+)")
+# fields parsed out of the scanner replies, matched on the raw reply bytes
+TASK_KEYS_PATTERN = re.compile(rb"taskKeys=([0-9, ]+)")
+CENTER_FREQ_PATTERN = re.compile(rb"cf=(\d+)")
+
+# reply that marks a command done, by command verb
+READY_TOKENS = {
+    "ConnectToScanner": b"ConnectToScanner=ok",
+    "Scan": b"acquisition=complete",
+    "ActivateTask": b"ActivateTask=ok",
+    "SelectTask": b"SelectTask=ok",
+    "PatientTable": b"PatientTable=ok",
+    "LoadProtocol": b"LoadProtocol=ok",
+    "SetCVs": b"SetCVs=ok",
+    "SetShimValues": b"SetShimValues=ok",
+    "Help": b"Help",
+}
+# commands that are done with whatever reply comes back
+ALWAYS_READY = frozenset({"SetGrxSlices", "SetRxsomething...."}) #TODO: what is this command?
+
+# every ExSI frame we send starts with this header, the third field is the payload length
+FRAME_HEADER = struct.Struct('!HHIII')
+# a reply is only cut on its length field when its header starts like ours (header size 16),
+# the length is sane and the payload opens with '<'; anything else is read like a bare '<' message
+FRAME_MAGIC = struct.pack('!H', FRAME_HEADER.size)
+MAX_FRAME_PAYLOAD = 1 << 20
+
+# fixed pieces of the scanner log lines, the log is written as bytes
+RECV_PREFIX = b" Received: "
+FAIL_PREFIX = b"Command Failed: "
+FAIL_SUFFIX = b"\nClearing Command Queue\n\n"
+
 
 class exsi:
-    def __init__(self, config, shimZeroFunc=None, shimCurrentFunc=None, debugging=False, output_file='scanner_log.txt'):
+    def __init__(self, config, shimZeroFunc=None, shimCurrentFunc=None, debugging=False, output_file='scanner_log.txt', shimCurrentsFunc=None):
         self.debugging = debugging
 
         self.host = config['host']
@@ -15,21 +53,34 @@ class exsi:
         self.exsiProduct = config['exsiProduct']
         self.exsiPasswd  = config['exsiPasswd']
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.settimeout(1)  # Set a timeout of 1 second
+        self.s.settimeout(1)  # Set a timeout of 1 second, for connecting and sending
+        # small request/reply traffic, don't let Nagle hold a command back waiting on the previous ACK
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 256*1024)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1<<20)
+        # the receive thread sleeps in select until the scanner sends something or stop() writes to the shutdown pipe
+        self._sel = selectors.DefaultSelector()
+        self._shutdown_r, self._shutdown_w = os.pipe()
+        self._sel.register(self._shutdown_r, selectors.EVENT_READ)
+        self._rxbuf = bytearray() # received bytes not yet parsed into complete messages
+        self._rxview = memoryview(bytearray(65536)) # reused by every recv_into
 
         # cond vars
         self.send_event = threading.Event() # for every time command is sent to scanner
         self.ready_event = threading.Event()
-        self.images_ready_event = threading.Event()
+        self.images_ready_sem = threading.Semaphore(0) # released once per images ready notification, so none get lost between waits
         self.connected_ready_event = threading.Event()
         self.no_failures = threading.Event() # for when command fails. 
         self.no_failures.set() # set to true initially
         self.prescanDone = threading.Event() # for when prescan is done
 
         # queues
-        self.command_queue = queue.Queue()  # Command queue
+        # Command queue; append/popleft on a deque are atomic, cmd_event wakes the command processor
+        self.command_queue = deque()
+        self.cmd_event = threading.Event()
         self.output_file = output_file
         self.last_command = ""
+        self.last_verb = "" # first word of last_command, is_ready dispatches on it
         # task queue, if a protocol is loaded so that we can run tasks in order
         # NOTE: "task" as in task numbers related to the individual scanned sequences in an Exam
         self.task_queue = queue.Queue() 
@@ -48,10 +99,19 @@ class exsi:
             self.sendCurrentCmd = lambda channel, current: shimCurrentFunc(channel, current)
             self.sendZeroCmd = lambda : shimZeroFunc()
             self.clearShimQueue = lambda : None
+            # batched form, fed a list of (channel, current) pairs; falls back to one call per channel
+            if shimCurrentsFunc is not None:
+                self.sendCurrentsCmd = lambda currents: shimCurrentsFunc(currents)
+            else:
+                self.sendCurrentsCmd = lambda currents: [shimCurrentFunc(channel, current) for channel, current in currents]
 
-        # Clear the Log
-        with open(self.output_file, 'w'):
-            pass
+        # called from the receive thread once the exam info is known; set by the shimTool
+        self.onConnected = lambda : None
+
+        # Clear the Log, and keep it open for the lifetime of the client;
+        # writes are buffered and only flushed and synced to disk once a command completes or something fails
+        self._log_fd = os.open(self.output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        self.log_fh = os.fdopen(self._log_fd, 'wb', buffering=64*1024)
 
         self.connectExsi()
 
@@ -59,6 +119,7 @@ class exsi:
         try:
             self.s.connect((self.host, self.port))
             print(f"INFO EXSI CLIENT: Socket connected")
+            self._sel.register(self.s, selectors.EVENT_READ)
             # these trigger the connected event!
             self.running = True
             self.start_receiving_thread()
@@ -74,47 +135,48 @@ class exsi:
         def process_commands():
             while self.running:
                 try:
-                    # Wait for up to 1 second
-                    cmd = self.command_queue.get(timeout=1) 
-                    print("EXSI CLIENT DEBUG: Processing command: ", cmd)
-                    # check if we need to initialize current switch as well...
-                    pattern = r"(\d+)\s(\d+\.\d+)"
-                    if "|" in cmd:
-                        # Proess synced shim current set command for calibration (Zero first, and also load protocol)
-                        cmd = cmd.split(" | ")
-                        cmd, current_cmd = cmd[0], cmd[1]
-                        match = re.match(pattern, current_cmd)
-                        channel = int(match.group(1))
-                        current = float(match.group(2))
-                        if self.debugging:
-                            print(f"EXSI CLIENT Debug: SEND CURRENT COMMAND, channel {channel} current {current:.2f}")
-                        self.sendZeroCmd()
-                        self.sendCurrentCmd(channel, current)
-                    if cmd.startswith("X"):
-                        # Proess synced shim current set command. shouldn't queue anything else after this
-                        match = re.match(pattern, cmd)
-                        channel = int(match.group(1))
-                        current = float(match.group(2))
-                        self.sendCurrentCmd(channel, current)
-                        if self.debugging:
-                            print(f"EXSI CLIENT Debug: SEND SYNC CURRENT COMMAND, channel {channel} current {current:.2f}")
-                        continue
-                    if not "WaitImagesReady" in cmd:
-                        # don't send a command if we are just using a dummy message to wait for images to be collected...
-                        self._send_command(cmd)
-                    else:
-                        self.last_command = cmd
-                    #TODO: see if this timeout of 60 can be fixed in any way here...
-                    ready = self.ready_event.wait(60)
-                    if not ready:
-                        self.stop()
-                        raise TimeoutError(f"Error: Command {cmd} was sent to scanner. Timeout waiting for valid recv.")
-                    # Response was recieved, clear the event and pop cmd from queue
-                    self.ready_event.clear()
-                    self.command_queue.task_done()
-                except queue.Empty:
-                    # Go back to the start of the loop to check self.running again
+                    cmd = self.command_queue.popleft()
+                except IndexError:
+                    # Wait for up to 1 second, then go back to the start of the loop to check self.running again
+                    self.cmd_event.wait(timeout=1)
+                    self.cmd_event.clear()
+                    continue
+                print("EXSI CLIENT DEBUG: Processing command: ", cmd)
+                # check if we need to initialize current switch as well...
+                if "|" in cmd:
+                    # Proess synced shim current set command for calibration (Zero first, and also load protocol)
+                    cmd = cmd.split(" | ")
+                    cmd, current_cmd = cmd[0], cmd[1]
+                    match = CURRENT_PATTERN.match(current_cmd)
+                    channel = int(match.group(1))
+                    current = float(match.group(2))
+                    if self.debugging:
+                        print(f"EXSI CLIENT Debug: SEND CURRENT COMMAND, channel {channel} current {current:.2f}")
+                    self.sendZeroCmd()
+                    self.sendCurrentCmd(channel, current)
+                if cmd.startswith("X"):
+                    # Proess synced shim current set command, "X ch current [ch current ...]". shouldn't queue anything else after this
+                    # split rather than match a pattern, so currents keep whatever precision (or exponent) str() gave them
+                    fields = cmd.split()[1:]
+                    currents = [(int(channel), float(current)) for channel, current in zip(fields[0::2], fields[1::2])]
+                    self.sendCurrentsCmd(currents)
+                    if self.debugging:
+                        print(f"EXSI CLIENT Debug: SEND SYNC CURRENT COMMAND, {' '.join(f'channel {channel} current {current:.2f}' for channel, current in currents)}")
                     continue
+                if not "WaitImagesReady" in cmd:
+                    # don't send a command if we are just using a dummy message to wait for images to be collected...
+                    self._send_command(cmd)
+                else:
+                    self.last_command = cmd
+                    self.last_verb = "WaitImagesReady"
+                #TODO: see if this timeout of 60 can be fixed in any way here...
+                ready = self.ready_event.wait(60)
+                if not ready:
+                    # leave the teardown to whoever owns the client, stop() would be joining this thread
+                    self.running = False
+                    raise TimeoutError(f"Error: Command {cmd} was sent to scanner. Timeout waiting for valid recv.")
+                # Response was recieved, clear the event
+                self.ready_event.clear()
 
         self.command_processor_thread = threading.Thread(target=process_commands)
         self.command_processor_thread.daemon = True
@@ -132,49 +194,57 @@ class exsi:
         else:
             # check if we are trying to queue the next task without 
             # a task number specified; i.e. it looks like 'taskkey='
-            if re.search("SelectTask taskkey=(?!\d+)", cmd) is not None:
+            if SELECT_TASK_PATTERN.search(cmd) is not None:
                 # pull the next task from the task list and append
                 tasktodo = str(self.task_queue.get())
                 self.task_queue.task_done()  
-                self.command_queue.put(cmd + tasktodo)
+                self.command_queue.append(cmd + tasktodo)
+                self.cmd_event.set()
                 return
             elif 'scan' in cmd:
-                self.images_ready_event.clear()
+                self.clear_images_ready()
             # add command directly to queue if nothing is special
-            self.command_queue.put(cmd)
+            self.command_queue.append(cmd)
+            self.cmd_event.set()
             self.send_event.clear()
 
+    def wait_images_ready(self, timeout=None):
+        """Block until one more images ready notification arrives, returns False on timeout."""
+        return self.images_ready_sem.acquire(timeout=timeout)
+
+    def clear_images_ready(self):
+        """Drop any images ready notifications that nobody waited for yet."""
+        while self.images_ready_sem.acquire(blocking=False):
+            pass
+
     def _send_command(self, cmd):     
         if cmd is not None:
             self.ready_event.clear()
             self.last_command = cmd
-            tcmd = b'>heartvista:1:' + str(self.counter).encode('utf-8') + b'>' + cmd.encode('utf-8')
+            self.last_verb = cmd.split(' ', 1)[0]
+            tcmd = b'>heartvista:1:%d>%s' % (self.counter, cmd.encode('utf-8'))
             self.counter += 1
-            self.s.send(struct.pack('!H', 16))
-            self.s.send(struct.pack('!H', 1000))
-            self.s.send(struct.pack('!I', len(tcmd)))
-            self.s.send(struct.pack('!I', 0))
-            self.s.send(struct.pack('!I', 100))
-            self.s.send(tcmd)
+            # the whole frame, header and command, goes out in one call; sendall retries short sends
+            self.s.sendall(FRAME_HEADER.pack(16, 1000, len(tcmd), 0, 100) + tcmd)
             self.send_event.set()
 
     def receive_loop(self):
         while self.running:
             try:
-                msg = self.rcv()
-                if msg:
+                events = self._sel.select(timeout=None)
+                if any(key.fileobj == self._shutdown_r for key, _ in events):
+                    break
+                self._drain_socket()
+                for msg in self._parse_messages():
+                    if not msg:
+                        continue
                     success, is_ready, images_ready = self.is_ready(msg)
-                    with open(self.output_file, 'a') as file:
-                        current_time = datetime.now()
-                        # Format the current time as a string (e.g., HH:MM:SS)
-                        formatted_time = current_time.strftime('%H:%M:%S')
-                        file.write(f"{formatted_time} Received: " + msg + "\n")
+                    current_time = datetime.now()
+                    # Format the current time as a string (e.g., HH:MM:SS)
+                    formatted_time = current_time.strftime('%H:%M:%S')
+                    self._log(formatted_time.encode() + RECV_PREFIX + msg + b"\n")
                     if not success:
-                        notify = "Command Failed: "
-                        notify += self.last_command
-                        notify += "\nClearing Command Queue\n\n"
-                        with open(self.output_file, 'a') as file:
-                            file.write(notify)
+                        self._log(FAIL_PREFIX + self.last_command.encode('utf-8') + FAIL_SUFFIX)
                         print(f"EXSI CLIENT DEBUG: Command {self.last_command} failed, clearing command queue.")
                         self.clear_command_queue()  # Clear the queue on failure
                         self.clearShimQueue() # Clear the shim queue too on failure
@@ -183,87 +253,90 @@ class exsi:
                         self.no_failures.clear()
                         # set these so that gui can resume control and not sit in wait
                         self.ready_event.set()
-                        self.images_ready_event.set()
+                        self.images_ready_sem.release()
+                    if is_ready or images_ready or not success:
+                        self._flush_log()
                     if is_ready:
                         self.ready_event.set()
                     if images_ready:
-                        print(f"EXSI CLIENT DEBUG: setting images_ready_event") 
-                        self.images_ready_event.set()
-            except socket.timeout:
-                continue
+                        print(f"EXSI CLIENT DEBUG: releasing images_ready_sem") 
+                        self.images_ready_sem.release()
             except Exception as e:
-                with open(self.output_file, 'a') as file:
-                    file.write("Error receiving data: " + str(e) + \
-                               "\n!!!Please Restart the Client!!!\n")
+                self._log(("Error receiving data: " + str(e) + "\n!!!Please Restart the Client!!!\n").encode('utf-8'), flush=True)
                 break
 
-    def rcv(self, length=6000):
-        data = self.s.recv(length)
-        msg = str(data, 'UTF-8', errors='ignore')
-        msg = msg[msg.find('<')+1:]
-        return msg
+    def _drain_socket(self):
+        """Append whatever the scanner sent to the receive buffer; a message can span several recvs."""
+        n = self.s.recv_into(self._rxview)
+        if not n:
+            raise ConnectionError("Connection closed by the scanner.")
+        self._rxbuf += self._rxview[:n]
+
+    def _parse_messages(self):
+        """Yield the message bytes of every complete reply in the receive buffer, leaving a partial frame for the next recv."""
+        buf = self._rxbuf
+        while buf:
+            if buf[:len(FRAME_MAGIC)] == FRAME_MAGIC[:len(buf)]:
+                if len(buf) <= FRAME_HEADER.size:
+                    return # header (or the '<' after it) not in yet
+                length = FRAME_HEADER.unpack_from(buf)[2]
+                if 0 < length <= MAX_FRAME_PAYLOAD and buf[FRAME_HEADER.size] == ord('<'):
+                    end = FRAME_HEADER.size + length
+                    if len(buf) < end:
+                        return
+                    # the message itself starts after the '<' of the payload
+                    msg = bytes(buf[FRAME_HEADER.size+1:end])
+                    del buf[:end]
+                    yield msg
+                    continue
+            # not a header we recognise: take everything after the first '<' as one message, like a plain recv did
+            msg = bytes(buf[buf.find(b'<')+1:])
+            buf.clear()
+            yield msg
 
     def is_ready(self, msg):
         # Return a tuple (success, is_ready, images_ready)
+        # msg is the raw reply; the token checks stay on bytes, only the fields we keep get decoded
         
         success = True  # Assume success unless a failure condition is detected
         ready = False 
         images_ready = False
 
-        if "images available" in msg:
-            print(f"EXSI CLIENT DEBUG: Images are ready. in msg: {msg}")
+        if b"images available" in msg:
+            print(f"EXSI CLIENT DEBUG: Images are ready. in msg: {msg.decode('utf-8', errors='ignore')}")
             images_ready = True
 
         # TODO: this is kind of a confuzzling place to put this contradiction
-        if "fail" in msg:
+        if b"fail" in msg:
             success = False # Command failed
             ready = True # ready for next command bc we clear the queue
-            
-        # Check for specific command completion or readiness indicators
-        elif self.last_command.startswith("ConnectToScanner"):
-            ready = "ConnectToScanner=ok" in msg
-        elif self.last_command.startswith("Scan"):
-            ready = "acquisition=complete" in msg
-        elif self.last_command.startswith("WaitImagesReady"):
+            return (success, ready, images_ready)
+
+        # Check for specific command completion or readiness indicators, looked up by the command verb
+        verb = self.last_verb
+        token = READY_TOKENS.get(verb)
+        if token is not None:
+            ready = token in msg
+        elif verb in ALWAYS_READY:
+            ready = True
+        elif verb == "WaitImagesReady":
             ready = images_ready
-        elif self.last_command.startswith("ActivateTask"):
-            ready = "ActivateTask=ok" in msg
-        elif self.last_command.startswith("SelectTask"):
-            ready = "SelectTask=ok" in msg
-        elif self.last_command.startswith("PatientTable"):
-            ready = "PatientTable=ok" in msg
-        elif self.last_command.startswith("LoadProtocol"):
-            ready = "LoadProtocol=ok" in msg
-            # i want to use regex to extract out task keys from message.
-            pattern = r"taskKeys=([0-9, ]+)"
-            match = re.search(pattern, msg)
-            if match:
-                taskKeys = match.group(1).split(',')
-                taskKeys = [int(key.strip()) for key in taskKeys]
-                print(f"EXSI CLIENT DEBUG: Task keys found in message: ", taskKeys)
-                self.taskKeys = taskKeys
-                for task in taskKeys:
-                    self.task_queue.put(task)
-            # else:
-            #     print(f"EXSI CLIENT DEBUG: No task keys found in message: {msg}")
-        elif self.last_command.startswith("SetCVs"):
-            ready = "SetCVs=ok" in msg
-        elif self.last_command.startswith("Prescan"):
+        elif verb == "Prescan":
             if "auto" in self.last_command:
-                if "scanner=idle" in msg:
+                if b"scanner=idle" in msg:
                     ready = True
                     self.prescanDone.set()
             elif "skip" in self.last_command:
-                ready = "Prescan=ok" in msg
+                ready = b"Prescan=ok" in msg
             elif "values=hide" in self.last_command: # for setting the center frequency
-                ready = "Prescan=ok" in msg
+                ready = b"Prescan=ok" in msg
                 # extract the new center frequency from the message
-                pattern = r"cf=(\d+)"
-                match = re.search(pattern, msg)
+                match = CENTER_FREQ_PATTERN.search(msg)
                 if match:
-                    self.newCenterFreq = match.group(1)
-        elif self.last_command.startswith("GetExamInfo"):
-            if "GetExamInfo=ok" in msg:
+                    self.newCenterFreq = match.group(1).decode()
+        elif verb == "GetExamInfo":
+            if b"GetExamInfo=ok" in msg:
+                msg = msg.decode('utf-8', errors='ignore')
                 ref = "0020,0010="
                 examnumstart = msg.find(ref) + len(ref)
                 self.examNumber = msg[examnumstart:examnumstart+5]
@@ -273,50 +346,98 @@ class exsi:
                 self.patientName = msg[patientnamestart:patientnameend]
                 ready = True
                 self.connected_ready_event.set() # This only needs to happen once
-        elif self.last_command.startswith("GetPrescanValues"):
-            if "GetPrescanValues=ok" in msg:
-                pattern = r"cf=(\d+)"
-                match = re.search(pattern, msg)
+                self.onConnected()
+        elif verb == "GetPrescanValues":
+            if b"GetPrescanValues=ok" in msg:
+                match = CENTER_FREQ_PATTERN.search(msg)
                 if match:
-                    self.ogCenterFreq = match.group(1)
+                    self.ogCenterFreq = match.group(1).decode()
                     print(f"EXSI CLIENT DEBUG: Center frequency found in message: {self.ogCenterFreq}")
                 else:
                     print("EXSI CLIENT DEBUG: Center frequency not found in message.")
                 ready = True
-        elif self.last_command.startswith("SetGrxSlices"):
-            ready = True
-        elif self.last_command.startswith("SetRxsomething...."): #TODO: what is this command?
-            ready = True
-        elif self.last_command.startswith("SetShimValues"):
-            ready = "SetShimValues=ok" in msg
-        elif self.last_command.startswith("Help"):
-            ready = "Help" in msg
-            
         else:
             # Default condition if none of the above matches
-            ready = "NotifyEvent" in msg        # Default readiness condition
+            ready = b"NotifyEvent" in msg        # Default readiness condition
+
+        if verb == "LoadProtocol":
+            # i want to use regex to extract out task keys from message.
+            match = TASK_KEYS_PATTERN.search(msg)
+            if match:
+                taskKeys = match.group(1).split(b',')
+                taskKeys = [int(key.strip()) for key in taskKeys]
+                print(f"EXSI CLIENT DEBUG: Task keys found in message: ", taskKeys)
+                self.taskKeys = taskKeys
+                for task in taskKeys:
+                    self.task_queue.put(task)
 
         return (success, ready, images_ready)
 
+    def _log(self, data, flush=False):
+        """Append bytes to the scanner log. Buffered unless flush is set; dropped once stop() closed the log."""
+        if self.log_fh.closed:
+            return
+        self.log_fh.write(data)
+        if flush:
+            self._flush_log()
+
+    def _flush_log(self):
+        """Push the buffered log out and fsync it, so it survives a crash up to this point."""
+        if self.log_fh.closed:
+            return
+        self.log_fh.flush()
+        os.fsync(self._log_fd)
+
     def clear_command_queue(self):
-        while not self.command_queue.empty():
-            try:
-                cmd = self.command_queue.get_nowait()
-                print(f"EXSI CLIENT DEBUG: Clearing command: {cmd}")
-                self.command_queue.task_done()
-            except queue.Empty:
-                break
-        with open(self.output_file, 'a') as file:
-            file.write("Command queue cleared due to failure.\n")
+        if self.command_queue:
+            print(f"EXSI CLIENT DEBUG: Clearing commands: {', '.join(self.command_queue.copy())}")
+        self.command_queue.clear()
+        self._log(b"Command queue cleared due to failure.\n", flush=True)
 
     def stop(self):
         self.running = False
+        if getattr(self, 'log_fh', None) is None:
+            # __init__ failed before the client was fully set up, only release what it had opened
+            self._close_resources()
+            return
         # print out command queue if it is not empty
         self.clear_command_queue()
-        if self.running:
+        # wake both threads: the command processor out of its waits, the receive thread out of select
+        self.cmd_event.set()
+        self.ready_event.set()
+        if self._shutdown_w is not None:
+            try:
+                os.write(self._shutdown_w, b'\0')
+            except OSError:
+                pass
+        # stop() can run on either worker thread (e.g. __del__ on whichever drops the last reference), never join the calling thread
+        for thread in (getattr(self, 'command_processor_thread', None), getattr(self, 'receiving_thread', None)):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(timeout=1)
+        if not self.log_fh.closed:
+            self.log_fh.close()
+        try:
             self.s.shutdown(socket.SHUT_RDWR)
-            self.s.close()
             print("INFO EXSI CLIENT: socket closed successfully. bye.")
+        except OSError:
+            pass # never connected, or already shut down
+        # whether or not the joins timed out; a receive thread still in select just errors out of it
+        self._close_resources()
+
+    def _close_resources(self):
+        """Close the socket, the selector and the shutdown pipe. Safe to call again, or on a partly constructed client."""
+        sel = getattr(self, '_sel', None)
+        if sel is not None:
+            self._sel = None
+            sel.close()
+        for name in ('_shutdown_r', '_shutdown_w'):
+            fd = getattr(self, name, None)
+            if fd is not None:
+                setattr(self, name, None)
+                os.close(fd)
+        sock = getattr(self, 's', None)
+        if sock is not None:
+            sock.close()
         
     ##### EXSI CLIENT CONTROL FUNCTIONS #####   
 
@@ -3,15 +3,16 @@ This module contains the GUI for the application.
 Includes both ui instantiation, as well as the logic for populating UI with data
 """
 
-from guiUtils import *
-from utils import *
+from shimTool.guiUtils import *
+from shimTool.utils import *
 import pickle
-from PyQt6.QtWidgets import QMainWindow, QBoxLayout, QVBoxLayout, QWidget, QTextEdit, QLabel, QSlider, QHBoxLayout, QLineEdit, QGraphicsView, QGraphicsScene, QGraphicsPixmapItem, QGraphicsTextItem, QTabWidget, QCheckBox, QSizePolicy, QButtonGroup, QRadioButton, QGraphicsItem
-from PyQt6.QtCore import Qt
-from PyQt6.QtGui import QPixmap, QImage, QDoubleValidator, QIntValidator, QPainter, QPen, QBrush, QColor
+from collections import OrderedDict, deque
+from PyQt6.QtWidgets import QMainWindow, QBoxLayout, QVBoxLayout, QWidget, QTextEdit, QLabel, QSlider, QHBoxLayout, QLineEdit, QTabWidget, QCheckBox, QSizePolicy, QButtonGroup, QRadioButton
+from PyQt6.QtCore import Qt, QTimer, pyqtSignal
+from PyQt6.QtGui import QPixmap, QImage, QTextCursor, QDoubleValidator, QIntValidator, QPainter, QPen, QBrush, QColor
 
-from exsi_client import exsi
-from shim_client import shim
+from shimTool.exsi_client import exsi
+from shimTool.shim_client import shim
 from shimTool import shimTool
 
 class Gui(QMainWindow):
@@ -21,6 +22,10 @@ class Gui(QMainWindow):
     and performing various operations related to calibration, scanning, and shimming.
     """
 
+    # emitted from the client threads once they connect, so that the gui is updated on the gui thread
+    exsiConnected = pyqtSignal(object, object) # exam number, patient name
+    shimConnected = pyqtSignal()
+
     def __init__(self, debugging, shimTool: shimTool, exsiInstance: exsi, shimInstance: shim, scannerLog, shimLog):
         super().__init__()
 
@@ -44,12 +49,47 @@ class Gui(QMainWindow):
         # should be roi view, shim view, and then basis view
         self.views = []
 
+        # LRU cache of rendered pixmaps, so scrolling back over slices doesnt redo the qt image conversion
+        self.pixmapCache = OrderedDict()
+        self.pixmapCacheSize = 64
+
+        # coalesce bursts of slider signals; only the latest queued update per key runs, at most once per tick
+        self.pendingUpdates = {}
+        self.coalesceTimer = QTimer(self)
+        self.coalesceTimer.setSingleShot(True)
+        self.coalesceTimer.setInterval(16) # ~60 Hz
+        self.coalesceTimer.timeout.connect(self.flushPendingUpdates)
+        # the last (view, value) each index slider scheduled an update for; the entries re-send it on every editingFinished
+        self.lastIndexValues = {}
+
+        # the latest lines of each log output, shown in one go per coalesce tick instead of appending every chunk
+        self.logLineLimit = 5000
+        self.logLines = {}
+
         # ----- GUI Properties that act as state, in addition to all the gui features that hold state ----- #
 
         self.viewDataSlice = np.array([np.nan for _ in range(3)], dtype=object) # three sets of 2D Slice Data that is actually visualized
+        # the (3D volume, slice axis, slice index) that each viewDataSlice was taken from
+        self.viewSources = [None for _ in range(3)]
+        # per view {id(volume): (volume, slice axis, scale, uint8 volume)}, the display ready versions of the volumes being scrolled through
+        # the shim and basis views switch between several volumes, so keep one for each of them
+        self.displayVolumes = [{} for _ in range(3)]
+        # per view (uint8 buffer, QImage over that buffer), reused for every slice of the same shape
+        self.viewImages = [None for _ in range(3)]
+        # (height, width, RGBA) buffer of the ROI overlay drawn on top of the roi view,
+        # and the (height, width, RGB) canvas that it is drawn onto, each with a QImage over it
+        self.roiOverlayBuffer = None
+        self.roiOverlay: QImage = None
+        self.roiCanvasBuffer = None
+        self.roiCanvas: QImage = None
 
         # the value range for each view
         self.viewMaxAbs = [0 for _ in range(3)]
+        # per shim map (stats strings it was formatted from, display text of every slice)
+        self.shimStatPrefixes = ("Background ", "Est. ", "Actual ")
+        self.shimStatTexts = [None for _ in range(3)]
+        # the volumes each viewMaxAbs was last reduced over, so unchanged data is not reduced again on every slider tick
+        self.viewMaxAbsSources = [None for _ in range(3)]
 
         # start building the state vector for the GUI. These are all the essential data structures that are necessary to reload the app
         self.state = {
@@ -58,6 +98,8 @@ class Gui(QMainWindow):
 
         # ----- GUI Initialization ----- #
         self.initUI()
+        self.exsiConnected.connect(self.onExsiConnected)
+        self.shimConnected.connect(lambda: self.renameTab(self.shimmingTab, "Shim Control"))
         
 
     ##### GUI LAYOUT RELATED FUNCTIONS #####   
@@ -112,13 +154,13 @@ class Gui(QMainWindow):
         self.centralTabWidget.addTab(self.basisTab, "Basis/Performance Visualization")
 
         # Connect the log monitor
-        self.exsiLogMonitorThread = LogMonitorThread(self.scannerLog)
-        self.exsiLogMonitorThread.update_log.connect(partial(self.updateLogOutput, self.exsiLogOutput))
-        self.exsiLogMonitorThread.start()
+        self.exsiLogMonitor = LogMonitor(self.scannerLog, self)
+        self.exsiLogMonitor.update_log.connect(partial(self.updateLogOutput, self.exsiLogOutput))
+        self.exsiLogMonitor.start()
 
-        self.shimLogMonitorThread = LogMonitorThread(self.shimLog)
-        self.shimLogMonitorThread.update_log.connect(partial(self.updateLogOutput, self.shimLogOutput))
-        self.shimLogMonitorThread.start()
+        self.shimLogMonitor = LogMonitor(self.shimLog, self)
+        self.shimLogMonitor.update_log.connect(partial(self.updateLogOutput, self.shimLogOutput))
+        self.shimLogMonitor.start()
     
     def setupBasicTabLayout(self, layout: QBoxLayout):
         """ Setup the layout for the basic tab.  This tab contains the main controls for the Exsi system, such as calibration, scanning, and ROI selection.
@@ -133,7 +175,8 @@ class Gui(QMainWindow):
         basicLayout.addLayout(imageLayout)
 
         # Slider for selecting slices
-        packed = addLabeledSliderAndEntry(imageLayout, "Slice Index (Int): ", QIntValidator(0, 0), self.updateROIImageDisplay)
+        packed = addLabeledSliderAndEntry(imageLayout, "Slice Index (Int): ", QIntValidator(0, 0), 
+                                          lambda value: self.scheduleIfChanged("roiSlice", self.updateROIImageDisplay, (self.getROIBackgroundSelected(), value)))
         self.roiSliceIndexSlider, self.roiSliceIndexEntry = packed
         self.roiSliceIndexSlider.setEnabled(False) 
         self.roiSliceIndexEntry.setEnabled(False) # start off disabled -- no image is viewed yet!
@@ -160,11 +203,11 @@ class Gui(QMainWindow):
         self.roiPositionSliders = [None for _ in range(3)]
         for i in range(3):
             self.roiSizeSliders[i] = addLabeledSlider(roiSizeSliders, f"Size {label[i]}", self.roiSliderGranularity)
-            self.roiSizeSliders[i].valueChanged.connect(self.visualizeROI)
+            self.roiSizeSliders[i].valueChanged.connect(lambda value: self.scheduleUpdate("roi", self.visualizeROI))
             self.roiSizeSliders[i].setEnabled(False)
 
             self.roiPositionSliders[i] = addLabeledSlider(roiPositionSliders, f"Center {label[i]}", self.roiSliderGranularity)
-            self.roiPositionSliders[i].valueChanged.connect(self.visualizeROI)
+            self.roiPositionSliders[i].valueChanged.connect(lambda value: self.scheduleUpdate("roi", self.visualizeROI))
             self.roiPositionSliders[i].setEnabled(False)
 
         self.roiToggleButton = addButtonConnectedToFunction(imageLayout, "Enable ROI Editor", self.toggleROIEditor)
@@ -250,7 +293,7 @@ class Gui(QMainWindow):
         self.shimVizButtonGroup.idClicked.connect(self.toggleShimImage)
 
         # add another graphics scene visualizer
-        # Setup QGraphicsView for image display
+        # Setup ImageViewer for image display
         # TODO issue #7 add a function to do all this and also make the color bar inherent
         self.shimViewLabel = QLabel()
         self.shimView = ImageViewer(self, self.shimViewLabel)
@@ -310,7 +353,8 @@ class Gui(QMainWindow):
 
 
         # ACTUAL SHIM OPERATIONS START
-        packed = addLabeledSliderAndEntry(layout, "Slice Index (Int): ", QIntValidator(0, 0), self.updateShimImageAndStats)
+        packed = addLabeledSliderAndEntry(layout, "Slice Index (Int): ", QIntValidator(0, 0), 
+                                          lambda value: self.scheduleIfChanged("shimSlice", self.updateShimImageAndStats, (self.getShimViewTypeSelected(), value)))
         self.shimSliceIndexSlider, self.shimSliceIndexEntry = packed
         self.shimSliceIndexSlider.setEnabled(False)
         self.shimSliceIndexEntry.setEnabled(False)
@@ -437,13 +481,13 @@ class Gui(QMainWindow):
         self.basisFunctionSlider, self.basisFunctionEntry = addLabeledSliderAndEntry(leftLayout, 
                                                                                      "Basis Function Index (Int): ", 
                                                                                      QIntValidator(0, numbasis - 1), 
-                                                                                     self.updateBasisView)
+                                                                                     lambda value: self.scheduleIfChanged("basisFunction", self.updateBasisView, (self.getBasisSliceIndex(), value)))
         updateSliderEntryLimits(self.basisFunctionSlider, self.basisFunctionEntry, 0, numbasis - 1, 0)
 
         # add a label and select for the slice index
         self.basisSliceIndexSlider, self.basisSliceIndexEntry = addLabeledSliderAndEntry(leftLayout, "Slice Index (Int): ", 
                                                                                          QIntValidator(0, 0), 
-                                                                                         self.updateBasisView)
+                                                                                         lambda value: self.scheduleIfChanged("basisSlice", self.updateBasisView, (self.getBasisFunctionIndex(), value)))
         self.basisSliceIndexEntry.setEnabled(False)
         self.basisSliceIndexEntry.setEnabled(False)
 
@@ -516,6 +560,10 @@ class Gui(QMainWindow):
                               f" Patient: {patientName or '!'} ]"
         self.setWindowTitle(self.guiWindowTitle)
     
+    def onExsiConnected(self, examNumber, patientName):
+        self.setWindowAndExamNumber(examNumber, patientName)
+        self.renameTab(self.exsiTab, "ExSI Control")
+
     def onTabSwitch(self, index):
         self.log(f"Switched to tab {index}")
         if index == 0:
@@ -529,54 +577,131 @@ class Gui(QMainWindow):
         if index == 2:
             self.updateBasisView()
 
-    def updateLogOutput(self, log, text):
-        log.append(text)
+    def scheduleUpdate(self, key, func):
+        """Queue func to run on the next coalesce tick, replacing whatever was already queued under key"""
+        self.pendingUpdates[key] = func
+        if not self.coalesceTimer.isActive():
+            self.coalesceTimer.start()
+
+    def scheduleIfChanged(self, key, func, value):
+        """scheduleUpdate func under key, unless the last update under key was already for this same value.
+        value is (selected view or volume, slider value), so coming back to an index after switching what it indexes still updates"""
+        if self.lastIndexValues.get(key) == value:
+            return
+        self.lastIndexValues[key] = value
+        self.scheduleUpdate(key, func)
 
-    def setView(self, qImage: QImage, view: ImageViewer):
-        """Sets the view of the ImageViewer to the given QImage."""
-        pixmap = QPixmap.fromImage(qImage)
-        view.viewport().setVisible(True)
+    def flushPendingUpdates(self):
+        """Run the latest queued update for every key"""
+        pending, self.pendingUpdates = self.pendingUpdates, {}
+        for func in pending.values():
+            func()
+
+    def updateLogOutput(self, log, text):
+        lines = self.logLines.setdefault(log, deque(maxlen=self.logLineLimit))
+        lines.extend(text.splitlines())
+        self.scheduleUpdate(log, partial(self.flushLogOutput, log))
+
+    def flushLogOutput(self, log):
+        log.setPlainText("\n".join(self.logLines[log]))
+        log.moveCursor(QTextCursor.MoveOperation.End)
+
+    def setView(self, qImage: QImage, view: ImageViewer, pixmap: QPixmap = None):
+        """Sets the view of the ImageViewer to the given QImage, or the already converted pixmap if given."""
+        if pixmap is None:
+            pixmap = QPixmap.fromImage(qImage)
         view.set_pixmap(pixmap)
-        view.setSceneRect(view.pixmap_item.boundingRect())  # Adjust scene size to the pixmap's bounding rect
-        view.fitInView(view.pixmap_item, Qt.AspectRatioMode.KeepAspectRatio)  # Fit the view to the item
-        view.viewport().update()  # Force the viewport to update
 
     def updateAllDisplays(self):
         # actions to update the rest of the GUI objects with the loaded data
+        # the volumes behind every view changed, so no remembered slider value is current anymore
+        self.lastIndexValues.clear()
         self.updateROIImageDisplay()
         self.updateShimImageAndStats()
         self.updateBasisView()
         if self.doBackgroundScansMarker.isChecked():
             self.roiVizButtonGroup.buttons()[1].setEnabled(True)
 
+    def getDisplayVolume(self, viewIndex, volume, sliceAxis):
+        """Return the uint8 display version of the whole volume, normalized the same way as each of its slices.
+        Only recomputed when the volume or its scale changes, so switching slices just indexes into it."""
+        scale = self.viewMaxAbs[viewIndex]
+        cache = self.displayVolumes[viewIndex]
+        cached = cache.get(id(volume))
+        if cached is not None and cached[0] is volume and cached[1] == sliceAxis and cached[2] == scale:
+            return cached[3]
+        # minimum of every slice, ignoring the nans outside of the mask
+        otherAxes = tuple(axis for axis in range(volume.ndim) if axis != sliceAxis)
+        sliceMins = np.fmin.reduce(volume, axis=otherAxes, keepdims=True)
+        if viewIndex > 0:
+            # when we are looking at b0maps, the numbers can be negative
+            factor, offset = (127 / (2*scale) if scale else 0), 127
+        else:
+            factor, offset = (255 / scale if scale else 0), 0
+        # fold the offset into the (tiny) per slice minimums, so that the volume only goes through
+        # one subtract into a float32 working buffer and one in place multiply
+        shift = sliceMins - offset / factor if factor else sliceMins
+        normalizedData = np.subtract(volume, shift, dtype=np.float32)
+        normalizedData *= factor
+        # make the value 0 wherever it is outside of mask, and keep everything in the uint8 range
+        # before the cast, since casting nan or out of range floats to uint8 is undefined
+        np.nan_to_num(normalizedData, copy=False, nan=0.0)
+        np.clip(normalizedData, 0, 255, out=normalizedData)
+        displayVolume = normalizedData.astype(np.uint8)
+        # a new scale invalidates every cached volume of this view, and replaced volumes should not pile up
+        maxVolumes = 1 if viewIndex == 0 else len(self.shimTool.viewData[viewIndex])
+        if any(entry[2] != scale for entry in cache.values()) or len(cache) >= maxVolumes:
+            cache.clear()
+            self.dropPixmaps(viewIndex)
+        else:
+            # whatever was rendered under this id came from an older volume, axis or scale
+            self.dropPixmaps(viewIndex, id(volume))
+        cache[id(volume)] = (volume, sliceAxis, scale, displayVolume)
+        return displayVolume
+
+    def dropPixmaps(self, viewIndex, volumeId=None):
+        """Forget the cached pixmaps of a view, or only the ones rendered from one of its volumes."""
+        for key in [key for key in self.pixmapCache if key[0] == viewIndex and (volumeId is None or key[1] == volumeId)]:
+            del self.pixmapCache[key]
+
+    def ensureQImage(self, viewIndex, shape):
+        """Return the (buffer, QImage) pair backing a view, only reallocating it when the slice shape changes."""
+        height, width = shape
+        cached = self.viewImages[viewIndex]
+        if cached is not None and cached[0].shape == (height, width):
+            return cached
+        buffer = np.empty((height, width), dtype=np.uint8)
+        qImage = QImage(buffer.data, width, height, buffer.strides[0], QImage.Format.Format_Grayscale8)
+        # the qImage does not own its buffer, so keep it alive alongside it
+        self.viewImages[viewIndex] = (buffer, qImage)
+        return buffer, qImage
+
     def updateDisplay(self, viewIndex):
         """Update a specific view with the corresponding underlying data available."""
         viewDataSlice = self.viewDataSlice[viewIndex] # this should be a 2d numpy array now
         # if view data is not none, then so should the slice and maxAbs value
         if viewDataSlice is not None:
-            # Extract the slice and normalize it
-            scale = self.viewMaxAbs[viewIndex]
-            if viewIndex > 0:
-                # when we are looking at b0maps, the numbers can be negative
-                scale = 2*scale 
-                normalizedData = (viewDataSlice - np.nanmin(viewDataSlice)) / scale * 127 + 127
+            volume, sliceAxis, sliceIdx = self.viewSources[viewIndex]
+            displayVolume = self.getDisplayVolume(viewIndex, volume, sliceAxis)
+            displayData = displayVolume[(slice(None),) * sliceAxis + (sliceIdx,)]
+            buffer, qImage = self.ensureQImage(viewIndex, displayData.shape)
+            np.copyto(buffer, displayData)
+            # check if this exact slice was already rendered, by what it was rendered from; the display volume cache
+            # holds on to every volume it has an entry for, so their ids stay unique while their pixmaps are cached
+            key = (viewIndex, id(volume), sliceAxis, sliceIdx, self.viewMaxAbs[viewIndex])
+            pixmap = self.pixmapCache.get(key)
+            if pixmap is not None:
+                self.pixmapCache.move_to_end(key)
             else:
-                normalizedData = (viewDataSlice - np.nanmin(viewDataSlice)) / scale * 255
-            # make the value 127 (correlates to 0 Hz offset) wherever it is outside of mask
-            normalizedData[np.isnan(viewDataSlice)] = 0
-            # specific pyqt6 stuff to convert numpy array to QImage
-            displayData = np.ascontiguousarray(normalizedData).astype(np.uint8)
-            # stack 4 times for R, G, B, and alpha value
-            rgbData = np.stack((displayData,)*3, axis=-1)
-            height, width, _ = rgbData.shape
-            bytesPerLine = rgbData.strides[0] 
-            qImage = QImage(rgbData.data, width, height, bytesPerLine, QImage.Format.Format_RGB888)
+                pixmap = QPixmap.fromImage(qImage)
+                self.pixmapCache[key] = pixmap
+                if len(self.pixmapCache) > self.pixmapCacheSize:
+                    self.pixmapCache.popitem(last=False)
             # set the actual view that we care about
             self.views[viewIndex].qImage = qImage
             self.views[viewIndex].viewData = viewDataSlice
-            self.setView(qImage, self.views[viewIndex])
+            self.setView(qImage, self.views[viewIndex], pixmap)
 
-        
     def visualizeROI(self):
         """
         Visualize the ROI based on the current selected shape type slider values.
@@ -613,14 +738,33 @@ class Gui(QMainWindow):
 
         sliceIdx = self.roiSliceIndexSlider.value()
         offsetFromDepthCenter = abs(sliceIdx - self.shimTool.ROI.centers[2])
-        drawingQImage = qImage.copy()
-        if offsetFromDepthCenter <= self.shimTool.ROI.sizes[2]:
+        drawingQImage = qImage
+        if self.viewImages[0] is None:
+            # nothing has been rendered into the gray view buffer yet, so there is nothing to draw the ROI onto
+            self.setView(drawingQImage, self.views[0])
+            return
+        grayBuffer = self.viewImages[0][0]
+        height, width = grayBuffer.shape
+        # the ROI mask follows the ROI limits, the view follows the displayed data; only overlay when they agree
+        roiFits = 0 <= sliceIdx < self.shimTool.ROI.zdim and (self.shimTool.ROI.ydim, self.shimTool.ROI.xdim) == (height, width)
+        if offsetFromDepthCenter <= self.shimTool.ROI.sizes[2] and roiFits:
+            # the view itself is grayscale; only a slice that shows the ROI needs a color canvas to draw on
+            if self.roiOverlayBuffer is None or self.roiOverlayBuffer.shape[:2] != (height, width):
+                self.roiOverlayBuffer = np.zeros((height, width, 4), dtype=np.uint8)
+                self.roiOverlay = QImage(self.roiOverlayBuffer.data, width, height, self.roiOverlayBuffer.strides[0], QImage.Format.Format_RGBA8888)
+            else:
+                self.roiOverlayBuffer.fill(0)
+            if self.roiCanvasBuffer is None or self.roiCanvasBuffer.shape[:2] != (height, width):
+                self.roiCanvasBuffer = np.empty((height, width, 3), dtype=np.uint8)
+                self.roiCanvas = QImage(self.roiCanvasBuffer.data, width, height, self.roiCanvasBuffer.strides[0], QImage.Format.Format_RGB888)
+            # reuse the same canvas every time, just refilling it with the current gray slice
+            np.copyto(self.roiCanvasBuffer, grayBuffer[..., None])
+            drawingQImage = self.roiCanvas
+            # rasterize the ROI slice into a semi transparent red RGBA overlay, and blend it on with one blit
+            sliceMask = self.shimTool.ROI.getSliceMask(sliceIdx)
+            self.roiOverlayBuffer[sliceMask] = (255, 0, 0, 100)
             painter = QPainter(drawingQImage)
-            # Set the pen color to red and the brush to a semi transparent red
-            painter.setPen(QPen(QBrush(QColor(255, 0, 0, 100)), 1))
-            points = self.shimTool.ROI.getSlicePoints(sliceIdx)
-            for x, y in points:
-                painter.drawPoint(x, y)
+            painter.drawImage(0, 0, self.roiOverlay)
             painter.end()
         
         self.setView(drawingQImage, self.views[0])
@@ -637,8 +781,12 @@ class Gui(QMainWindow):
         self.roiSliceIndexEntry.setEnabled(True)
         # the data should have already been placed into viewData
 
-        # get the max abs value of the background data
-        self.viewMaxAbs[0] = np.max(np.abs(self.shimTool.viewData[0]))
+        # get the max abs value of the background data, from its extremes rather than an abs copy of the volume,
+        # and only when the data has been replaced since the last check
+        roiData = self.shimTool.viewData[0]
+        if self.viewMaxAbsSources[0] is None or self.viewMaxAbsSources[0][0] is not roiData:
+            self.viewMaxAbs[0] = max(abs(float(roiData.max())), abs(float(roiData.min())))
+            self.viewMaxAbsSources[0] = [roiData]
         # if the data is background
         if self.roiVizButtonGroup.checkedId() == 1:
             if not self.doBackgroundScansMarker.isChecked():
@@ -650,6 +798,7 @@ class Gui(QMainWindow):
                                     # assume that slider value automatically updated to be within bounds
             # need to set viewDataSlice to the desired slice
             self.viewDataSlice[0] = self.shimTool.viewData[0][:,self.roiSliceIndexSlider.value(),:]
+            self.viewSources[0] = (self.shimTool.viewData[0], 1, self.roiSliceIndexSlider.value())
             # set ROI limits TODO issue #1
             ydim, zdim, xdim = self.shimTool.viewData[0].shape
             self.shimTool.ROI.setROILimits(xdim, ydim, zdim)
@@ -661,6 +810,7 @@ class Gui(QMainWindow):
                                     # assume that slider value automatically updated to be within bounds
             # need to set viewDataSlice to the desired slice
             self.viewDataSlice[0] = self.shimTool.viewData[0][self.roiSliceIndexSlider.value()]
+            self.viewSources[0] = (self.shimTool.viewData[0], 0, self.roiSliceIndexSlider.value())
         return True
 
     def updateROIImageDisplay(self):
@@ -689,6 +839,15 @@ class Gui(QMainWindow):
                     self.roiPositionSliders[i].setEnabled(True)
             self.updateROIImageDisplay()
 
+    def updateViewMaxAbs(self, viewIndex, volumes):
+        """Grow viewMaxAbs of the view to cover the given volumes, skipping the reduction if they were already covered."""
+        checked = self.viewMaxAbsSources[viewIndex]
+        if checked is not None and len(checked) == len(volumes) and all(a is b for a, b in zip(checked, volumes)):
+            return
+        for volume in volumes:
+            self.viewMaxAbs[viewIndex] = max(self.viewMaxAbs[viewIndex], np.nanmax(np.abs(volume)))
+        self.viewMaxAbsSources[viewIndex] = volumes
+
     def validateShimInputs(self):
         """Validate the shim input sliders and entries.
            The data should already be updated to be masked with final ROI"""
@@ -701,9 +860,7 @@ class Gui(QMainWindow):
             return False
 
         # get the max abs value of the shimView data set        
-        for i in range(self.shimTool.viewData[1].shape[0]):
-            if self.shimTool.viewData[1][i] is not None:
-                self.viewMaxAbs[1] = max(self.viewMaxAbs[1], np.nanmax(np.abs(self.shimTool.viewData[1][i])))
+        self.updateViewMaxAbs(1, [data for data in self.shimTool.viewData[1] if data is not None])
 
         # set the limit to the shim slice index slider 
         upperlimit = self.shimTool.viewData[1][0].shape[1]-1
@@ -715,22 +872,29 @@ class Gui(QMainWindow):
         self.shimSliceIndexEntry.setEnabled(True)
         # set the viewDataSlice to the desired slice from the whole 4D data set
         self.viewDataSlice[1] = self.shimTool.viewData[1][selectedShimView][:,self.shimSliceIndexSlider.value(),:]
+        self.viewSources[1] = (self.shimTool.viewData[1][selectedShimView], 1, self.shimSliceIndexSlider.value())
         return True
     
+    def getShimStatTexts(self, i):
+        """Return the display text of every slice's stats for shim map i, only formatting them again when the stats are replaced."""
+        statStrs = self.shimTool.shimStatStrs[i]
+        cached = self.shimStatTexts[i]
+        if cached is None or cached[0] is not statStrs:
+            texts = None
+            if statStrs is not None:
+                texts = [self.shimStatPrefixes[i] + (stats if stats is not None else "\nNo stats available") for stats in statStrs]
+            self.shimStatTexts[i] = (statStrs, texts)
+        return self.shimStatTexts[i][1]
+
     def updateShimStats(self):
         """Update the shim statistics text boxes."""
         # get the slice index from the slider
         sliceIndex = self.getShimSliceIndex()
         # set the text to the text boxes
         # show as many stats as are available for the specific slice
-        prefixs = ["Background ", "Est. ", "Actual "]
         for i in range(3):
-            text = "\nNo stats available"                
-            if self.shimTool.shimStatStrs[i] is not None:
-                stats = self.shimTool.shimStatStrs[i][sliceIndex]
-                if stats is not None:
-                    text = stats
-            text = prefixs[i] + text
+            texts = self.getShimStatTexts(i)
+            text = texts[sliceIndex] if texts is not None else self.shimStatPrefixes[i] + "\nNo stats available"
             self.shimStatText[i].setText(text)
 
         # if original gradients / original center frequency available 
@@ -745,18 +909,14 @@ class Gui(QMainWindow):
         if self.shimTool.solutionValuesToApply is not None:
             if self.shimTool.solutionValuesToApply[sliceIndex] is not None:
                 solutions = self.shimTool.solutionValuesToApply[sliceIndex]
-                text = f"Δcf:{int(round(solutions[0]))}|"
-                numIter = self.shimInstance.numLoops + 3
-                pref = ["X", "Y", "Z"]
-                for i in range(numIter):
-                    if i < 3:
-                        text += 'g' + pref[i]
-                        text += f":{int(round(solutions[i+1]))}|"
-                    else:
-                        text += f"ch{i-3}:{solutions[i+1]:.2f}|"
+                # cf, then the X Y Z gradients, then each loop channel
+                parts = [f"Δcf:{int(round(solutions[0]))}"]
+                parts += [f"g{axis}:{int(round(solutions[i+1]))}" for i, axis in enumerate(("X", "Y", "Z"))]
+                parts += [f"ch{i}:{solutions[i+4]:.2f}" for i in range(self.shimInstance.numLoops)]
+                text = "|".join(parts)
             else:
-                text = "No currents available "
-            self.currentsDisplay.setText(text[:-1])
+                text = "No currents available"
+            self.currentsDisplay.setText(text)
         else:
             self.currentsDisplay.setText("No currents available")
 
@@ -778,12 +938,10 @@ class Gui(QMainWindow):
         """Validate the inputs for the Basis Views"""
 
         # get the max abs value of the basisView data set
-        for i in range(self.shimTool.viewData[2].shape[0]):
-            if self.shimTool.viewData[2][i] is not None:
-                self.viewMaxAbs[2] = max(self.viewMaxAbs[2], np.nanmax(np.abs(self.shimTool.viewData[2][i])))
-            else:
-                self.log("ERROR: Calibration scans done marker checked, but basis data is not available yet")
-                return False # cancel the viewing, since clearly some of the data is not there yet...
+        if any(basis is None for basis in self.shimTool.viewData[2]):
+            self.log("ERROR: Calibration scans done marker checked, but basis data is not available yet")
+            return False # cancel the viewing, since clearly some of the data is not there yet...
+        self.updateViewMaxAbs(2, list(self.shimTool.viewData[2]))
 
         # set the limit to the basis slice index slider
         numslices = self.shimTool.viewData[2][0].shape[1]-1
@@ -796,6 +954,7 @@ class Gui(QMainWindow):
 
         # set the viewDataSlice to the desired slice from the whole 4D data set
         self.viewDataSlice[2] = self.shimTool.viewData[2][self.basisFunctionSlider.value()][:,self.basisSliceIndexSlider.value(),:]
+        self.viewSources[2] = (self.shimTool.viewData[2][self.basisFunctionSlider.value()], 1, self.basisSliceIndexSlider.value())
         return True
 
     def updateBasisView(self):
@@ -2,63 +2,102 @@
 File for all the Utility functions for the GUI
 """
 
-import time
-from PyQt6.QtWidgets import QMessageBox, QPushButton, QLabel, QLineEdit, QHBoxLayout, QSlider, QSizePolicy, QCheckBox, QBoxLayout
-from PyQt6.QtCore import pyqtSignal, QObject, QThread, pyqtSignal, Qt
-from PyQt6.QtWidgets import QGraphicsView, QGraphicsScene
-from PyQt6.QtGui import QValidator, QIntValidator, QImage
+import os
+from PyQt6.QtWidgets import QMessageBox, QPushButton, QLabel, QLineEdit, QHBoxLayout, QSlider, QSizePolicy, QCheckBox, QBoxLayout, QWidget
+from PyQt6.QtCore import pyqtSignal, QObject, QFileSystemWatcher, pyqtSignal, Qt, QRect, QPoint
+from PyQt6.QtGui import QValidator, QIntValidator, QImage, QPixmap, QPainter
 from functools import partial
 import numpy as np
 import inspect
 
-class LogMonitorThread(QThread):
+class LogMonitor(QObject):
+    """Emits the text appended to a log file, whenever the file changes on disk"""
     update_log = pyqtSignal(str)
 
     def __init__(self, filename, parent=None):
-        super(LogMonitorThread, self).__init__(parent)
+        super(LogMonitor, self).__init__(parent)
         self.filename = filename
-        self.running = True
-
-    def run(self):
-        self.running = True
-        with open(self.filename, 'r') as file:
-            # Move to the end of the file
+        self.offset = 0 # byte offset of what has already been emitted
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.readAppended)
+
+    def start(self):
+        # Move to the end of the file, only new log lines are shown
+        if os.path.exists(self.filename):
+            self.offset = os.path.getsize(self.filename)
+        self.watcher.addPath(self.filename)
+
+    def readAppended(self):
+        """Read only the bytes appended since the last change and emit them"""
+        with open(self.filename, 'rb') as file:
             file.seek(0, 2)
-            while self.running:
-                line = file.readline()
-                if not line:
-                    time.sleep(0.1)  # Sleep briefly to allow for a stop check
-                    continue
-                self.update_log.emit(line)
+            if file.tell() < self.offset:
+                self.offset = 0 # the log was cleared, start over
+            file.seek(self.offset)
+            data = file.read()
+            self.offset = file.tell()
+        # files that get replaced instead of appended to drop out of the watcher
+        if self.filename not in self.watcher.files():
+            self.watcher.addPath(self.filename)
+        if data:
+            self.update_log.emit(data.decode('utf-8', errors='ignore'))
 
     def stop(self):
-        self.running = False
+        self.watcher.removePath(self.filename)
 
-class ImageViewer(QGraphicsView):
+class ImageViewer(QWidget):
+    """Widget that paints a single image scaled to fit, keeping its aspect ratio.
+    Painting the pixmap directly avoids the scene graph of a QGraphicsView for what is only ever one image."""
     def __init__(self, parent=None, label=None):
         super(ImageViewer, self).__init__(parent)
-        self.scene = QGraphicsScene(self)
-        self.setScene(self.scene)
-        self.pixmap_item = None
+        self.setMouseTracking(True) # report hovered values without needing a button held
+        self.pixmap: QPixmap = None
+        self.imageRect = QRect() # where in the widget the pixmap is drawn
+        self.renderHints = QPainter.RenderHint(0)
         self.qImage: QImage = None
         self.viewData = None # 2D data that the image viewer is currently being set to show
         self.label = label
 
         # TODO issue #7 add color bar
 
+    def setRenderHints(self, hints):
+        self.renderHints = hints
+
     def set_pixmap(self, pixmap):
-        if self.pixmap_item is None:
-            self.pixmap_item = self.scene.addPixmap(pixmap)
+        # only refit the target rect when the pixmap geometry actually changed
+        if self.pixmap is None or pixmap.size() != self.pixmap.size():
+            self.pixmap = pixmap
+            self.fitImageRect()
         else:
-            self.pixmap_item.setPixmap(pixmap)
-        self.pixmap = pixmap.toImage()
+            self.pixmap = pixmap
+        self.update()
+
+    def fitImageRect(self):
+        if self.pixmap is None or self.pixmap.isNull():
+            self.imageRect = QRect()
+            return
+        size = self.pixmap.size().scaled(self.size(), Qt.AspectRatioMode.KeepAspectRatio)
+        self.imageRect = QRect(QPoint((self.width() - size.width()) // 2, (self.height() - size.height()) // 2), size)
+
+    def resizeEvent(self, event):
+        self.fitImageRect()
+        super(ImageViewer, self).resizeEvent(event)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        if not self.imageRect.isEmpty():
+            painter.setRenderHints(self.renderHints)
+            painter.drawPixmap(self.imageRect, self.pixmap)
+        painter.end()
 
     def mouseMoveEvent(self, event):
-        if self.pixmap_item is not None and self.label is not None and self.viewData is not None:
-            point = self.mapToScene(event.pos())
-            x, y = int(point.x()), int(point.y())
+        if not self.imageRect.isEmpty() and self.label is not None and self.viewData is not None:
+            point = event.position()
+            # map from widget coordinates back into pixel coordinates of the image
+            x = int((point.x() - self.imageRect.x()) * self.pixmap.width() / self.imageRect.width())
+            y = int((point.y() - self.imageRect.y()) * self.pixmap.height() / self.imageRect.height())
             if 0 <= x < self.pixmap.width() and 0 <= y < self.pixmap.height():
-                color = self.pixmap.pixelColor(x, y)
                 hz = self.viewData[y, x]
                 # Assuming there's a method to update a status bar or label:
                 self.label.setText(f"Coordinates: ({x}, {y}) - Value: {hz:.4f}")
@@ -129,6 +168,9 @@ def addLabeledSliderAndEntry(layout: QBoxLayout, labelStr: str, entryvalidator:
     entry.setValidator(entryvalidator)
     entry.setText(str(0))
 
+    # resolve once whether updateFunc wants the new value, rather than on every slider tick
+    if updateFunc and len(inspect.signature(updateFunc).parameters) == 0:
+        updateFunc = partial(_ignoreValue, updateFunc)
     slider.valueChanged.connect(partial(updateSlider, entry, updateFunc))
     entry.editingFinished.connect(partial(updateEntry, entry, slider, updateFunc))
 
@@ -142,7 +184,12 @@ def addLabeledSliderAndEntry(layout: QBoxLayout, labelStr: str, entryvalidator:
 def updateSliderEntryLimits(slider: QSlider, entry: QLineEdit, minVal: int, maxVal: int, defaultVal:int=None):
     slider.setMinimum(minVal)
     slider.setMaximum(maxVal)
-    entry.setValidator(QIntValidator(minVal, maxVal))
+    validator = entry.validator()
+    if isinstance(validator, QIntValidator):
+        # the entry already owns an int validator, just move its range
+        validator.setRange(minVal, maxVal)
+    else:
+        entry.setValidator(QIntValidator(minVal, maxVal, entry))
     if defaultVal is not None:
         slider.setValue(defaultVal)
         entry.setText(str(defaultVal))
@@ -172,20 +219,18 @@ def updateEntry(entry: QLineEdit, slider: QSlider, updateFunc):
     index = int(entry.text()) if entry.text() else 0
     slider.setValue(index)
     if updateFunc:
-        if len(inspect.signature(updateFunc).parameters) > 0:
-            updateFunc(index)
-        else:
-            updateFunc()
+        updateFunc(index)
 
 
 def updateSlider(entry: QLineEdit, updateFunc, value: int):
     """Update the entry to match the slider, and call the updateFunc with the new value"""
     entry.setText(str(value))
     if updateFunc:
-        if len(inspect.signature(updateFunc).parameters) > 0:
-            updateFunc(value)
-        else:
-            updateFunc()
+        updateFunc(value)
+
+def _ignoreValue(updateFunc, value):
+    """Call an updateFunc that takes no arguments from a slot that passes the new value"""
+    updateFunc()
 
 # ------------ gui ROI shapes ------------ #
 class ROIObject():
@@ -205,23 +250,29 @@ class ROIObject():
         self.updated = False
         self.enabled = False
         self.mask = None
+        self.maskKey = None # the (sizes, centers, limits) that self.mask was computed for
     
     def setROILimits(self, xdim, ydim, zdim):
         self.xdim = xdim
         self.ydim = ydim
         self.zdim = zdim
 
-    def getSlicePoints(self, sliceIdx: int):
+    def getBoundingBox(self):
         """
-        Return the points of the ellipse on the given slice
+        Return the x, y, z slices of the box that contains the ROI, clipped to the image limits
         """
-        points = []
-        if self.enabled:
-            for x in range(self.xdim):
-                for y in range(self.ydim):
-                    if self.isIMGPointInROI(x, y, sliceIdx):
-                        points.append((x, y))
-        return points
+        dims = [self.xdim, self.ydim, self.zdim]
+        return [slice(max(0, self.centers[i] - self.sizes[i]), min(dims[i], self.centers[i] + self.sizes[i] + 1)) 
+                for i in range(3)]
+
+    def getSliceMask(self, sliceIdx: int):
+        """
+        Return the 2D (y, x) boolean mask of the ROI on the given slice
+        """
+        if not self.enabled:
+            return np.zeros((self.ydim, self.xdim), dtype=bool)
+        # scrolling through slices of the same ROI just indexes into the cached volume mask
+        return self.getROIMask()[:, sliceIdx, :]
 
     def getROIMask(self):
         """
@@ -229,14 +280,24 @@ class ROIObject():
         """
         if not self.enabled:
             return None
-        if self.updated:
+        # only recompute when the ROI geometry or the image limits changed
+        key = (tuple(self.sizes), tuple(self.centers), self.xdim, self.ydim, self.zdim)
+        if self.mask is None or key != self.maskKey:
             # TODO issue #1
-            mask = np.zeros((self.ydim, self.zdim, self.xdim), dtype=bool)
-            for z in range(self.zdim):
-                for x in range(self.xdim):
-                    for y in range(self.ydim):
-                        mask[y, z, x] = self.isIMGPointInROI(x, y, z)
-                        self.mask = mask
+            shape = (self.ydim, self.zdim, self.xdim)
+            if self.mask is not None and self.mask.shape == shape and self.maskKey is not None:
+                # reuse the mask buffer, only the previous bounding box can have anything set in it
+                oldSizes, oldCenters = self.maskKey[0], self.maskKey[1]
+                oldBox = [slice(max(0, oldCenters[i] - oldSizes[i]), max(0, oldCenters[i] + oldSizes[i] + 1)) for i in range(3)]
+                self.mask[oldBox[1], oldBox[2], oldBox[0]] = False
+            else:
+                self.mask = np.zeros(shape, dtype=bool)
+            xs, ys, zs = self.getBoundingBox()
+            # evaluate the whole bounding box at once with broadcast coordinate grids,
+            # everything outside of the bounding box stays False
+            y, z, x = np.ogrid[ys, zs, xs]
+            self.mask[ys, zs, xs] = self.isIMGPointInROI(x, y, z)
+            self.maskKey = key
         return self.mask
 
     def isIMGPointInROI(self, x, y, z):
@@ -253,7 +314,8 @@ class ellipsoidROI(ROIObject):
         super().__init__()
     
     def isIMGPointInROI(self, x, y, z):
-        return ((x - self.centers[0])**2 / self.sizes[0]**2 +
-                (y - self.centers[1])**2 / self.sizes[1]**2 +
-                (z - self.centers[2])**2 / self.sizes[2]**2) <= 1
+        # reciprocal squared radii once per call, so the (possibly array) terms are only subtracts and multiplies
+        invX, invY, invZ = (1.0 / size**2 for size in self.sizes)
+        dx, dy, dz = x - self.centers[0], y - self.centers[1], z - self.centers[2]
+        return (dx*dx*invX + dy*dy*invY + dz*dz*invZ) <= 1
 
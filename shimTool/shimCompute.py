@@ -1,10 +1,19 @@
+import warnings
 import numpy as np
 from cvxopt import solvers, matrix
-from dicomUtils import *
+from shimTool.dicomUtils import *
 from typing import List
 from skimage.restoration import unwrap_phase
 from shimTool.utils import *
 
+# optional: combine the basis maps on the gpu when cupy and a cuda device are available
+try:
+    import cupy as cp
+    cupyAvailable = cp.cuda.is_available()
+except Exception:
+    cp = None
+    cupyAvailable = False
+
 def compute_b0map(first, second, te1, te2):
     # Naively compute the b0 map using two phase images from the scans with different TEs
     angle = np.angle(np.conj(first)*second)
@@ -15,33 +24,47 @@ def compute_b0map(first, second, te1, te2):
     angle = np.ma.filled(angle, fill_value=np.nan)
     return  angle / (2*np.pi) / ((te2-te1)*1e-3)
 
-def compute_b0maps(n, localExamRootDir, threshFactor=.4) -> List[np.ndarray]:
+def seriesModifiedTime(seriesPath):
+    """Latest modification time (ns) of the series directory or any file in it"""
+    with os.scandir(seriesPath) as entries:
+        return max([os.stat(seriesPath).st_mtime_ns] + [entry.stat().st_mtime_ns for entry in entries])
+
+def compute_b0maps(n, localExamRootDir, threshFactor=.4, seriesPaths=None) -> np.ndarray:
     # NOTE: Assumes that n most recent scans are all basis pair scans.
-    """ Computes the last n b0maps from pairs"""
-    seriesPaths = listSubDirs(localExamRootDir)
+    """ Computes the last n b0maps from pairs, stacked into one (n, ...) array
+    The stack is memory mapped to a .npy in the exam directory, so only the parts in use need to stay in RAM,
+    and it is reused instead of recomputed as long as none of the series it came from changed since.
+    seriesPaths can pin the series used, instead of the most recent ones in the exam directory"""
+    if seriesPaths is None:
+        seriesPaths = listSubDirs(localExamRootDir)
     seriesPaths = seriesPaths[-n*2:]
-    b0maps = []
+    # named after the inputs, so each computed set of maps gets its own file
+    stackPath = os.path.join(localExamRootDir, f"b0maps_{n}_{threshFactor}_{os.path.basename(seriesPaths[-1])}.npy")
+    if os.path.exists(stackPath) and os.stat(stackPath).st_mtime_ns >= max(seriesModifiedTime(path) for path in seriesPaths):
+        return np.load(stackPath, mmap_mode='r')
+
+    # write to a temporary file and only move it into place once complete, so a partial stack is never reused
+    partialPath = stackPath + ".partial"
+    b0maps = None
     for i in range(0, n*2, 2):
         phase1, te1, name1 = extractComplexImageData(seriesPaths[i], threshFactor=threshFactor)
         print(f"DEBUG: Extracted te1 {te1}, name1 {name1}")
         phase2, te2, name2 = extractComplexImageData(seriesPaths[i+1], threshFactor=threshFactor)
         print(f"DEBUG: Extracted te2 {te2}, name2 {name2}")
         b0map = compute_b0map(phase1, phase2, te1, te2)
-        b0maps.append(b0map)
-    return b0maps
-
-def subtractBackground(background, b0maps) -> List[np.ndarray]:
+        if b0maps is None:
+            b0maps = np.lib.format.open_memmap(partialPath, mode='w+', dtype=b0map.dtype, shape=(n, *b0map.shape))
+        b0maps[i//2] = b0map
+    b0maps.flush()
+    del b0maps # drop the writable mapping before the file becomes the cache
+    os.replace(partialPath, stackPath)
+    # hand out the same read-only mapping a cache hit would, so callers can't write back into the cache
+    return np.load(stackPath, mmap_mode='r')
+
+def subtractBackground(background, b0maps) -> np.ndarray:
     # NOTE: Assumes b0maps[0] is background and the rest are loops @ 1 A!!!!
-    bases = []
-    for i in range(len(b0maps)):
-        bases.append(b0maps[i] - background)
-    return bases
-
-def maskOneSlice(mask, sliceIdx) -> np.ndarray:
-    """Return the mask with only one slice filled; 3D Array in CORONAL ORIENTATION"""
-    newMask = np.zeros_like(mask)
-    newMask[:,sliceIdx,:] = mask[:,sliceIdx,:]
-    return newMask
+    """Return the bases as one contiguous (numBases, ...) stack"""
+    return np.asarray(b0maps) - background
 
 def createMask(background: np.ndarray, bases: List[np.ndarray], roi: np.ndarray) -> np.ndarray:
     """Create 3d boolean mask from background, bases and ROI"""
@@ -49,42 +72,63 @@ def createMask(background: np.ndarray, bases: List[np.ndarray], roi: np.ndarray)
     if background is None and np.array([base is None for base in bases]).any() and roi is None:
         raise ShimComputeError("At least one of background, bases or roi must be provided")
     
-    masks = []
+    mask = None
     if background is not None:
-        masks.append(~np.isnan(background))
+        mask = ~np.isnan(background)
 
     if np.array([base is not None for base in bases]).all():
-        for base in bases:
-            masks.append(~np.isnan(base))
+        # one reduction over all of the bases rather than a separate mask per base
+        basesValid = ~np.isnan(np.asarray(bases)).any(axis=0)
+        if mask is None:
+            mask = basesValid
+        else:
+            mask &= basesValid
 
     # then add roi if there is one; should already be boolean mask
     if roi is not None:
-        masks.append(roi)
-
-    # union the masks
-    mask = masks[0]
-    for m in masks[1:]:
-        mask = mask & m
+        # copy the roi mask rather than aliasing it, since the ROI object reuses its buffer
+        if mask is None:
+            mask = roi.copy()
+        else:
+            mask &= roi
     
     return mask
 
+def basesToDevice(basisStack: np.ndarray):
+    """Copy the basis stack onto the gpu once, to be reused by every computeExpectedB0Map; None without cupy"""
+    if not cupyAvailable or basisStack is None:
+        return None
+    return cp.asarray(basisStack)
+
+def computeExpectedB0Map(background: np.ndarray, bases: List[np.ndarray], solutions: List[np.ndarray], deviceBases=None) -> np.ndarray:
+    """Estimate the shimmed b0map by applying each slice's solution to that slice; 3D Array in CORONAL ORIENTATION
+    Slices without a solution are filled with nan
+    deviceBases is the same stack already on the gpu (see basesToDevice); without it everything runs on the cpu"""
+    solved = np.array([solution is not None for solution in solutions])
+    # (numSlices, cf + numBases) weights, zero for the unsolved slices
+    weights = np.zeros((background.shape[1], len(bases) + 1))
+    weights[solved] = np.stack([solution for solution in solutions if solution is not None])
+    basisStack = np.asarray(bases) # no copy when bases is already a stacked array
+    # expected[y,z,x] = background[y,z,x] + cf[z] + sum_c weights[z,c] * basis[c,y,z,x]
+    expected = background + weights[:, 0][None, :, None]
+    if deviceBases is not None:
+        # only the small weight matrix goes to the gpu per call
+        combined = cp.einsum('cyzx,zc->yzx', deviceBases, cp.asarray(weights[:, 1:]))
+        expected += cp.asnumpy(combined)
+    else:
+        expected += np.einsum('cyzx,zc->yzx', basisStack, weights[:, 1:], optimize=True)
+    expected[:, ~solved, :] = np.nan
+    return expected
+
 def solveCurrents(background, rawBases, mask, gradientCalStrength, loopCalStrength, debug=False, gradientMax_ticks=100, loopMaxCurrent_mA=2000) -> np.ndarray:
-    # make a copy so that we can work with that instead
-    bases = []
-
-    bases.append(np.ones(background.shape)) # add the constant basis for center frequency calc
-    for base in rawBases:
-        bases.append(base.copy())
-
-    vectorized = []
-    for i in range(len(bases)):
-        masked = bases[i][mask] 
-        # if debug:
-            # print(f"DEBUG: vector {i} has nans : {np.isnan(masked).any()}")
-        vectorized.append(masked)
-    
     # Craft the constrained Least Squares Problem
-    A = np.stack(vectorized, axis=1)
+    # gather the masked voxels of every basis straight into the columns of A, no copies of the full volumes,
+    # the first column is the constant basis for the center frequency calc
+    numVoxels = np.count_nonzero(mask)
+    A = np.empty((numVoxels, len(rawBases) + 1))
+    A[:, 0] = 1
+    for i, base in enumerate(rawBases):
+        A[:, i + 1] = base[mask]
     y = background[mask]
 
     if y.size == 0 or A.size == 0:
@@ -100,9 +144,10 @@ def solveCurrents(background, rawBases, mask, gradientCalStrength, loopCalStreng
 
     # constraint vectors
     g = np.vstack((np.eye(len(rawBases)+1), -np.eye(len(rawBases)+1))) # plus 4 for cf and 3 lin grads
-    h = np.ones(1)*2000 # for the center frequency in hz
-    h = np.concatenate((h, gradientMax_ticks / (np.ones(3)*gradientCalStrength))) # for the linear gradients 
-    h = np.concatenate((h, loopMaxCurrent_mA / (np.ones(len(rawBases)-3)*loopCalStrength)))
+    h = np.empty(len(rawBases)+1)
+    h[0] = 2000 # for the center frequency in hz
+    h[1:4] = gradientMax_ticks / gradientCalStrength # for the linear gradients 
+    h[4:] = loopMaxCurrent_mA / loopCalStrength
     h = np.concatenate((h, h)) # double it for the negative constraints
     
     # TODO(rob): fix these debug comments to show less
@@ -122,6 +167,9 @@ def solveCurrents(background, rawBases, mask, gradientCalStrength, loopCalStreng
 
     return np.array(res['x']).flatten()
 
+def statsString(std, mean, median, rmse):
+    return f" RESULTS (Hz):\nSt. Dev: {std:.3f}\nMean: {mean:.3f}\nMedian: {median:.3f}\nRMSE: {rmse:.3f}"
+
 def evaluate(d, debug=False):
     """ Evaluate a vector with basic stats"""
     std_og = np.nanstd(d)
@@ -129,10 +177,30 @@ def evaluate(d, debug=False):
     median_og = np.nanmedian(d)
     rmse = np.sqrt(np.nanmean(d**2))
     
-    stats = f" RESULTS (Hz):\nSt. Dev: {std_og:.3f}\nMean: {mean_og:.3f}\nMedian: {median_og:.3f}\nRMSE: {rmse:.3f}"
+    stats = statsString(std_og, mean_og, median_og, rmse)
     # if debug:
     #     print(stats)
     return stats, [std_og, mean_og, median_og, rmse]
 
+def evaluateSlicewise(volume, mask, debug=False):
+    """ Same stats as evaluate, for the masked values of every slice (axis 1) of the volume at once.
+    Returns lists of stat strings and stat values per slice, None for slices without any valid value."""
+    masked = np.where(mask, volume, np.nan)
+    with warnings.catch_warnings():
+        # slices outside the mask are all nan, they are dropped below
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        std = np.nanstd(masked, axis=(0, 2))
+        mean = np.nanmean(masked, axis=(0, 2))
+        median = np.nanmedian(masked, axis=(0, 2))
+        np.square(masked, out=masked)
+        rmse = np.sqrt(np.nanmean(masked, axis=(0, 2)))
+
+    statStrs = [None for _ in range(volume.shape[1])]
+    statVals = [None for _ in range(volume.shape[1])]
+    for j in np.flatnonzero(~np.isnan(mean)):
+        statStrs[j] = statsString(std[j], mean[j], median[j], rmse[j])
+        statVals[j] = [std[j], mean[j], median[j], rmse[j]]
+    return statStrs, statVals
+
 class ShimComputeError(Exception):
     pass
\ No newline at end of file
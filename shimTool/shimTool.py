@@ -2,19 +2,21 @@
 
 
 from datetime import datetime
-import sys, os, pickle, signal, code
+import sys, os, pickle, signal, code, subprocess, queue
 import numpy as np
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
 from PyQt6.QtWidgets import QApplication
 
 # Import the custom client classes and util functions
 from shimTool.exsi_client import exsi
 from shimTool.shim_client import shim
-from shimTool.dicomUtils import *
-from shimTool.shimCompute import *
-from shimTool.utils import *
-from shimTool.gui import *
+from shimTool.dicomUtils import listSubDirs, extractBasicImageData
+from shimTool.shimCompute import compute_b0maps, subtractBackground, createMask, solveCurrents, basesToDevice, computeExpectedB0Map, evaluate, evaluateSlicewise
+from shimTool.utils import load_config, log, setLogPath, kickoff_thread, getThreadFigure, execSFTPSync, getLastSetGradients, setGehcExamDataPath, \
+                           saveImage, saveStats, saveHistogram, saveHistogramsOverlayed
+from shimTool.gui import Gui, Trigger, createMessageBox, ellipsoidROI
 
 
 
@@ -52,13 +54,16 @@ class shimTool():
             with open(log, "w"): # remake the file empty
                 print(log)
                 pass
+        # route the log() lines into the configured gui log
+        setLogPath(self.guiLog)
 
         # ----------- Clients ----------- #
         # Start the connection from the Shim client.
         self.shimInstance = shim(self.config, self.shimLog, debugging=self.debugging)
 
         # Start the connection to the Scanner via ExSI.
-        self.exsiInstance = exsi(self.config, self.shimInstance.shimZero, self.shimInstance.shimSetCurrentManual, self.scannerLog, debugging=self.debugging)
+        self.exsiInstance = exsi(self.config, self.shimInstance.shimZero, self.shimInstance.shimSetCurrentManual, self.scannerLog, debugging=self.debugging,
+                                 shimCurrentsFunc=self.shimInstance.shimSetCurrentsManual)
         
         # connect the clear queue commands so that they can be called from the other client
         self.shimInstance.clearExsiQueue = self.exsiInstance.clear_command_queue
@@ -76,6 +81,8 @@ class shimTool():
         self.minCalibrationCurrent = 100 # 100 mA
         self.maxCalibrationCurrent = 2000 # 2 A
         self.loopCalCurrent = 1000 # 1 A
+        # persistent workers for saving figures, each one keeps and reuses its own figures
+        self.renderPool = ThreadPoolExecutor(max_workers=os.cpu_count())
 
  
         # ----------- Shim Tool State ----------- #
@@ -96,6 +103,8 @@ class shimTool():
         self.backgroundB0Map: np.ndarray = None # 3d array of the background b0 map 
         self.rawBasisB0maps: List[np.ndarray] = [None for _ in range(self.shimInstance.numLoops + 3)] # 3d arrays of the basis b0 maps with background
         self.basisB0maps: List[np.ndarray] = [None for _ in range(self.shimInstance.numLoops + 3)] # 3d arrays of the basis b0 maps without background
+        self.basisStack: np.ndarray = None # 4d (basis, y, z, x) contiguous array of the basis b0 maps without background; basisB0maps are views into it
+        self.deviceBasisStack = None # gpu copy of basisStack when cupy is available, made once whenever basisStack is set
         self.expectedB0Map: np.ndarray = None # 3d array of the shimmed b0 map; Shimming is slice-wise -> i.e. one slice is filled at a time per solution
         self.shimmedB0Map: np.ndarray = None # 3d array of the shimmed b0 map; Shimming is slice-wise -> i.e. one slice is filled at a time
 
@@ -135,26 +144,25 @@ class shimTool():
         if self.useGui:
             self.gui.show()
 
-        # wait for exsi connected to update the name of the GUI application, the tab, and to create the exam data directory
-        def waitForExSIConnectedReadyEvent():
-            if not self.exsiInstance.connected_ready_event.is_set():
-                self.exsiInstance.connected_ready_event.wait()
+        # once exsi is connected, update the name of the GUI application, the tab, and create the exam data directory
+        # these callbacks run on the client threads, so the gui is only touched through its (queued) signals
+        def onExSIConnected():
             self.localExamRootDir = os.path.join(self.config['rootDir'], "data", self.exsiInstance.examNumber)
-            if not os.path.exists(self.localExamRootDir):
-                os.makedirs(self.localExamRootDir)
+            os.makedirs(self.localExamRootDir, exist_ok=True)
             if self.useGui:
-                self.gui.setWindowAndExamNumber(self.exsiInstance.examNumber, self.exsiInstance.patientName)
-                self.gui.renameTab(self.gui.exsiTab, "ExSI Control")
-        # wait for the shim drivers connected to update the tab name
-        def waitForShimConnectedEvent():
-            if not self.shimInstance.connectedEvent.is_set():
-                self.shimInstance.connectedEvent.wait()
+                self.gui.exsiConnected.emit(self.exsiInstance.examNumber, self.exsiInstance.patientName)
+        # once the shim drivers are connected, update the tab name
+        def onShimConnected():
             if self.useGui:
-                self.gui.renameTab(self.gui.shimmingTab, "Shim Control")
-    
-        # let us hope that there isn't some race condition here...
-        kickoff_thread(waitForExSIConnectedReadyEvent)
-        kickoff_thread(waitForShimConnectedEvent)
+                self.gui.shimConnected.emit()
+
+        self.exsiInstance.onConnected = onExSIConnected
+        self.shimInstance.onConnected = onShimConnected
+        # the clients may have already connected before the callbacks were set
+        if self.exsiInstance.connected_ready_event.is_set():
+            onExSIConnected()
+        if self.shimInstance.connectedEvent.is_set():
+            onShimConnected()
 
         # start the PyQt event loop
         if self.useGui:
@@ -163,14 +171,16 @@ class shimTool():
     # ----------- Shim Tool Helper Functions ----------- #
 
     def transferScanData(self):
-        self.log(f"initiating transfer using rsync.")
+        self.log(f"initiating transfer over sftp.")
         if self.exsiInstance.examNumber is None:
             self.log("Error: No exam number found in the exsi client instance.")
             return
         if self.gehcExamDataPath is None:
             self.gehcExamDataPath = setGehcExamDataPath(self.exsiInstance.examNumber, self.config['host'], self.config['hvPort'], self.config['hvUser'], self.config['hvPassword'])
             self.log(f"obtained exam data path: {self.gehcExamDataPath}")
-        execRsyncCommand(self.config['hvPassword'], self.config['hvUser'], self.config['host'], self.gehcExamDataPath + '/*', self.localExamRootDir)
+        result = execSFTPSync(self.config['host'], self.config['hvPort'], self.config['hvUser'], self.config['hvPassword'],
+                              self.gehcExamDataPath, self.localExamRootDir)
+        self.log(f"transfer done: {result}")
 
     def getLatestData(self, stride=1, offset=0):
         latestDCMDir = listSubDirs(self.localExamRootDir)[-1]
@@ -232,6 +242,13 @@ class shimTool():
             
         # Finish applying values not originally in this class
         self.exsiInstance.ogCenterFreq = attr_dict['ogCenterFreq']
+        # the basis stack is not saved on its own; whatever stack this instance had belongs to the previous state,
+        # so always rebuild it from the loaded bases, making basisB0maps views into it again
+        self.basisStack = self.deviceBasisStack = None
+        if self.basisB0maps and all(basis is not None for basis in self.basisB0maps):
+            self.basisStack = np.stack(self.basisB0maps)
+            self.basisB0maps = list(self.basisStack)
+            self.deviceBasisStack = basesToDevice(self.basisStack)
         
         # load all the 
         if self.useGui:
@@ -247,7 +264,9 @@ class shimTool():
 
     def computeMask(self):
         """compute the mask for the shim images"""
-        self.finalMask = createMask(self.backgroundB0Map, self.basisB0maps, self.ROI.getROIMask())
+        # pass the contiguous stack when there is one, so the bases are checked without stacking them again
+        bases = self.basisStack if self.basisStack is not None else self.basisB0maps
+        self.finalMask = createMask(self.backgroundB0Map, bases, self.ROI.getROIMask())
         self.log(f"Computed Mask from background, basis and ROI.")
     
     def applyMask(self):
@@ -255,18 +274,20 @@ class shimTool():
 
         maps = [self.backgroundB0Map, self.expectedB0Map, self.shimmedB0Map]
         
-        # send the masked versions of the data to the GUI
+        # send the masked versions of the data to the GUI, masking each whole volume in a single pass
         for i, map in enumerate(maps):
             if map is not None:
-                toViewer = np.copy(map)
-                toViewer[~self.finalMask] = np.nan
-                self.viewData[1][i] = toViewer
+                self.viewData[1][i] = np.where(self.finalMask, map, np.nan)
         
-        for i, basis in enumerate(self.basisB0maps):
-            if basis is not None:
-                toViewer = np.copy(basis)
-                toViewer[~self.finalMask] = np.nan
-                self.viewData[2][i] = toViewer
+        if self.basisStack is not None:
+            # mask every basis at once over the contiguous stack, the viewer gets views into the result
+            maskedBases = np.where(self.finalMask, self.basisStack, np.nan)
+            for i in range(len(maskedBases)):
+                self.viewData[2][i] = maskedBases[i]
+        else:
+            for i, basis in enumerate(self.basisB0maps):
+                if basis is not None:
+                    self.viewData[2][i] = np.where(self.finalMask, basis, np.nan)
 
         self.log(f"Masked obtained data and sent to GUI.")
 
@@ -293,20 +314,21 @@ class shimTool():
         Save the generated expected B0 map to the expectedB0map array
         """
         # run whenever both backgroundB0Map and basisB0maps are computed or if one new one is obtained
-        self.basisB0maps = subtractBackground(self.backgroundB0Map, self.rawBasisB0maps)
+        self.basisStack = subtractBackground(self.backgroundB0Map, self.rawBasisB0maps)
+        self.basisB0maps = list(self.basisStack)
+        self.deviceBasisStack = basesToDevice(self.basisStack)
         self.computeMask()
 
-        self.solutions = [None for _ in range(self.backgroundB0Map.shape[1])]
-        for i in range(self.backgroundB0Map.shape[1]):
+        numSlices = self.backgroundB0Map.shape[1]
+        self.solutions = [None for _ in range(numSlices)]
+        for i in range(numSlices):
             # want to include slice in front and behind in the mask when solving currents though:
-            mask = maskOneSlice(self.finalMask, i)
-            if i > 0:
-                mask = np.logical_or(mask, maskOneSlice(self.finalMask, i-1))
-            if i < self.backgroundB0Map.shape[1] - 1:
-                mask = np.logical_or(mask, maskOneSlice(self.finalMask, i+1))
+            # so only hand the solver that slab of slices, instead of the full volumes with a one slab mask
+            slab = slice(max(0, i-1), min(numSlices, i+2))
             #NOTE: the first and last current that is solved will be for an empty slice...
-            self.solutions[i] = solveCurrents(self.backgroundB0Map, 
-                                             self.basisB0maps, mask, 
+            self.solutions[i] = solveCurrents(self.backgroundB0Map[:,slab,:], 
+                                             self.basisStack[:,:,slab,:], 
+                                             self.finalMask[:,slab,:], 
                                              self.gradientCalStrength,
                                              self.loopCalCurrent,
                                              debug=self.debugging)
@@ -315,16 +337,7 @@ class shimTool():
 
         # if not all currents are none
         if not all([c is None for c in self.solutions]):
-            self.expectedB0Map = self.backgroundB0Map.copy()
-            for i in range(self.backgroundB0Map.shape[1]):
-                if self.solutions[i] is not None:
-                    self.expectedB0Map[:,i,:] += self.solutions[i][0] * np.ones(self.backgroundB0Map[:,0,:].shape)
-                    numIter = self.shimInstance.numLoops + 3
-                    for j in range(numIter):
-                        # self.log(f"DEBUG: adding current {j} to shimData[1][{i}]")
-                        self.expectedB0Map[:,i,:] += self.solutions[i][j+1] * self.basisB0maps[j][:,i,:]
-                else:
-                    self.expectedB0Map[:,i,:] = np.nan
+            self.expectedB0Map = computeExpectedB0Map(self.backgroundB0Map, self.basisStack, self.solutions, self.deviceBasisStack)
             self.applyMask()
             self.log("Computed solutions and created new estimate shim maps")
             return True
@@ -332,9 +345,10 @@ class shimTool():
             self.log("Error: Could not solve for currents. Look at error hopefully in output")
             return False
 
-    def computeShimmedB0Map(self, idx):
-        """Compute the just obtained b0map of the shimmed background, for the specific slice selected"""
-        b0maps = compute_b0maps(1, self.localExamRootDir)
+    def computeShimmedB0Map(self, idx, seriesPaths=None):
+        """Compute the just obtained b0map of the shimmed background, for the specific slice selected.
+        seriesPaths pins the scan pair to use, otherwise the latest pair in the exam directory is used."""
+        b0maps = compute_b0maps(1, self.localExamRootDir, seriesPaths=seriesPaths)
         if self.shimmedB0Map is None:
             self.shimmedB0Map = np.full_like(b0maps[0], np.nan)
         self.shimmedB0Map[:,idx,:] = b0maps[0][:,idx,:]
@@ -344,14 +358,11 @@ class shimTool():
         """evaluate the shim images (with the final mask applied) and store the stats in the stats array."""
         for i, map in enumerate([self.backgroundB0Map, self.expectedB0Map, self.shimmedB0Map]):
             if map is not None:
-                self.shimStatStrs[i] = [None for _ in range(self.backgroundB0Map.shape[1])]
-                self.shimStats[i]  = [None for _ in range(self.backgroundB0Map.shape[1])]
-                for j in range(self.backgroundB0Map.shape[1]):
-                    mask = maskOneSlice(self.finalMask, j)
-                    if not np.isnan(map[mask]).all():
-                        statsstr, stats = evaluate(map[mask], self.debugging)
-                        self.shimStatStrs[i][j] = statsstr
-                        self.shimStats[i][j] = stats
+                # all slices in one pass over the masked volume
+                statStrs, statVals = evaluateSlicewise(map, self.finalMask, self.debugging)
+                # only publish complete lists, the gui caches its formatted text per list
+                self.shimStatStrs[i] = statStrs
+                self.shimStats[i] = statVals
     
     def evaluateAppliedShims(self, sliceIdx):
         """
@@ -359,39 +370,48 @@ class shimTool():
         Helpful to evaluate if the solutions are actually what is being applied.
         """
         b0maps = compute_b0maps(self.shimInstance.numLoops + 4, self.localExamRootDir)
+        evalDir = os.path.join(self.config['rootDir'], "results", self.exsiInstance.examNumber, "eval", f"slice_{sliceIdx}")
+        os.makedirs(evalDir, exist_ok=True)
+
+        # expected map of every applied term at once: background slice plus cf offset (i == 0), or plus one scaled basis slice
+        weights = np.asarray(self.solutions[sliceIdx])
+        basisSlices = self.basisStack[:, :, sliceIdx, :]
+        background = self.backgroundB0Map[:,sliceIdx,:]
+        expectedMaps = np.empty((len(b0maps), *background.shape), dtype=np.float32)
+        expectedMaps[0] = background + weights[0]
+        expectedMaps[1:] = background + weights[1:len(b0maps), None, None] * basisSlices[:len(b0maps)-1]
+
+        def saveDifference(i, difference):
+            fig, ax = getThreadFigure(figsize=(8, 6))
+            im = ax.imshow(difference, cmap='jet', vmin=-100, vmax=100)
+            fig.colorbar(im, ax=ax)
+            ax.set_title(f"difference basis{i}, slice{sliceIdx}", size=10)
+            ax.axis('off')
+            fig.savefig(os.path.join(evalDir, f"difference{i}.png"), bbox_inches='tight', transparent=False)
+
+        pool = self.renderPool
+        jobs = []
         for i in range(len(b0maps)):
             # save the b0map to the eval folder
-            evalDir = os.path.join(self.config['rootDir'], "results", self.exsiInstance.examNumber, "eval", f"slice_{sliceIdx}")
-            if not os.path.exists(evalDir):
-                os.makedirs(evalDir)
-            np.save(os.path.join(evalDir, f"b0map{i}.npy"), b0maps[i][:,sliceIdx,:])
+            np.save(os.path.join(evalDir, f"b0map{i}.npy"), b0maps[i][:,sliceIdx,:].astype(np.float32))
             # compute the difference from the expected b0map
-            expected = np.copy(self.backgroundB0Map[:,sliceIdx,:])
-            if i == 0:
-                expected += self.solutions[sliceIdx][i] * np.ones(expected.shape)
-            else:
-                expected += self.solutions[sliceIdx][i] * self.basisB0maps[i-1][:,sliceIdx,:]
-
+            expected = expectedMaps[i]
             np.save(os.path.join(evalDir, f"expected{i}.npy"), expected)
 
             difference = b0maps[i][:,sliceIdx,:] - expected
-            fig, ax = plt.subplots(figsize=(8, 6))
-            im = ax.imshow(difference, cmap='jet', vmin=-100, vmax=100)
-            cbar = plt.colorbar(im)
-
-            plt.title(f"difference basis{i}, slice{sliceIdx}", size=10)
-            plt.axis('off')
-            
-            fig.savefig(os.path.join(evalDir, f"difference{i}.png"), bbox_inches='tight', transparent=False)
-            plt.close(fig)
+            jobs.append(pool.submit(saveDifference, i, difference))
+        for job in jobs:
+            job.result()
 
     # ----------- SHIM Sub Operations ----------- #
         
     def setLinGradients(self, linGrad):
         """Set the new gradient as offset from the prescan set ones"""
+        x, y, z = linGrad
         if self.ogLinShimValues is not None:
-            linGrad = linGrad + self.ogLinShimValues
-        self.exsiInstance.sendSetShimValues(*linGrad)
+            ogX, ogY, ogZ = self.ogLinShimValues
+            x, y, z = x + ogX, y + ogY, z + ogZ
+        self.exsiInstance.sendSetShimValues(x, y, z)
 
     def sendSyncedShimCurrent(self, channel: int, current: float):
         """Send a shim loop set current command, but via the ExSI client 
@@ -399,6 +419,13 @@ class shimTool():
         # TODO: adjust for multiple boards
         self.exsiInstance.send(f"X {channel} {current}")
 
+    def sendSyncedShimCurrents(self, currents):
+        """Send the set currents of several loops as one ExSI queued command, so that they are synced with other
+        exsi commands and handed to the shim client in one go. currents is a list of (channel, current) pairs."""
+        # TODO: adjust for multiple boards
+        # full precision, the same as the single channel command; the arduino reads up to 19 characters of the value
+        self.exsiInstance.send("X " + " ".join(f"{channel} {current}" for channel, current in currents))
+
     def queueBasisPairScanDetails(self, linGrad=None, preset=False, prescan=False):
         """
         once the b0map sequence is loaded, subroutines are iterated along with cvs to obtain basis maps.
@@ -458,12 +485,10 @@ class shimTool():
                 self.exsiInstance.no_failures.set()
                 return False
             self.log(f"No Fail. Waiting for scan to complete, On scan {i+1} / {n}")
-            if not self.exsiInstance.images_ready_event.wait(timeout=90):
+            if not self.exsiInstance.wait_images_ready(timeout=90):
                 self.log(f"Error: scan {i+1} / {n} didn't complete within 90 seconds bruh")
-                return False
-            else:
-                self.exsiInstance.images_ready_event.clear()
                 # TODO probably should raise some sorta error here...
+                return False
         self.log(f"Done. {n} scans completed!")
         # after scans get completed, go ahead and get the latest scan data over on this machine...
         self.transferScanData()
@@ -535,6 +560,21 @@ class shimTool():
 
     # ----------- Shim Tool Scan Functions ----------- #
 
+    def runScanBatch(self, numScans, onDone, trigger:Trigger=None):
+        """Wait for numScans already queued scans to come back and then call onDone.
+        If onDone returns a value, it is the success of the operation reported through the trigger."""
+        self.exsiInstance.clear_images_ready()
+        if self.countScansCompleted(numScans):
+            success = onDone()
+            if trigger is not None and success is not None:
+                trigger.success = success
+        else:
+            self.log("Error: Scans didn't complete")
+            self.exsiInstance.clear_images_ready()
+            self.exsiInstance.ready_event.clear()
+        if trigger is not None:
+            trigger.finished.emit()
+
     @requireExsiConnection
     def doCalibrationScan(self, trigger: Trigger = None):
         if self.exsiInstance and not self.assetCalibrationDone:
@@ -543,9 +583,8 @@ class shimTool():
             self.exsiInstance.sendActTask()
             self.exsiInstance.sendPatientTable()
             self.exsiInstance.sendScan()
-            if self.exsiInstance.images_ready_event.wait(timeout=120):
+            if self.exsiInstance.wait_images_ready(timeout=120):
                 self.assetCalibrationDone = True
-                self.exsiInstance.images_ready_event.clear()
                 self.transferScanData()
                 self.getLatestData(stride=1)
         if trigger is not None:
@@ -560,10 +599,9 @@ class shimTool():
             self.exsiInstance.sendActTask()
             self.exsiInstance.sendPatientTable()
             self.exsiInstance.sendScan()
-            if not self.exsiInstance.images_ready_event.wait(timeout=120):
+            if not self.exsiInstance.wait_images_ready(timeout=120):
                 self.log(f"scan didn't complete")
             else:
-                self.exsiInstance.images_ready_event.clear()
                 self.transferScanData()
                 self.getLatestData(stride=1)
         if trigger is not None:
@@ -602,20 +640,13 @@ class shimTool():
         self.queueBasisPairScan()
         self.shimInstance.shimZero() # NOTE(rob): Hopefully this zeros quicker that the scans get set up...
         self.backgroundB0Map = None
-        self.exsiInstance.images_ready_event.clear()
-        if self.countScansCompleted(2):
+        def onDone():
             self.transferScanData()
             self.log("DEBUG: just finished all the background scans")
             self.computeBackgroundB0map()
             self.evaluateShimImages()
-            if trigger is not None:
-                trigger.success = True
-        else:
-            self.log("Error: Scans didn't complete")
-            self.exsiInstance.images_ready_event.clear()
-            self.exsiInstance.ready_event.clear()
-        if trigger is not None:
-            trigger.finished.emit()
+            return True
+        self.runScanBatch(2, onDone, trigger)
 
     @requireExsiConnection
     @requireShimConnection
@@ -634,23 +665,16 @@ class shimTool():
 
         self.shimInstance.shimZero() # NOTE: Hopefully this zeros quicker that the scans get set up...
         self.rawBasisB0maps = None
-        self.exsiInstance.images_ready_event.clear()
         num_scans = (self.shimInstance.numLoops + (3 if withLinGradients else 0)) * 2
-        if self.countScansCompleted(num_scans):
+        def onDone():
             self.log("DEBUG: just finished all the calibration scans")
             self.computeBasisB0maps(withLinGradients)
             # if this is a new background scan and basis maps were obtained, then compute the shim currents
             self.expectedB0Map = None
             success = self.computeShimCurrents()
-            if trigger is not None:
-                trigger.success = success # set the success of operation
             self.evaluateShimImages()
-        else:
-            self.log("Error: Scans didn't complete")
-            self.exsiInstance.images_ready_event.clear()
-            self.exsiInstance.ready_event.clear()
-        if trigger is not None:
-            trigger.finished.emit()
+            return success
+        self.runScanBatch(num_scans, onDone, trigger)
 
 
     @requireShimConnection
@@ -659,27 +683,25 @@ class shimTool():
 
         if self.solutions[sliceIdx] is not None:
             # setting center frequency
-            newCenterFreq = int(self.exsiInstance.ogCenterFreq) + int(round(self.solutionValuesToApply[sliceIdx][0]))
+            apply = self.solutionValuesToApply[sliceIdx]
+            newCenterFreq = int(self.exsiInstance.ogCenterFreq) + int(round(apply[0]))
             self.log(f"DEBUG: Setting center frequency from {self.exsiInstance.ogCenterFreq} to {newCenterFreq}")
             self.exsiInstance.sendSetCenterFrequency(newCenterFreq)
 
-            # setting the linear shims
+            # setting the linear shims, rounded straight to plain ints (round half to even, like np.round)
             if withLinGradients:
-                linGrads = self.solutionValuesToApply[sliceIdx][1:4]
-                linGrads = np.round(linGrads).astype(int)
-                self.setLinGradients(linGrads)
+                self.setLinGradients((int(round(apply[1])), int(round(apply[2])), int(round(apply[3]))))
                 
-            # setting the loop shim currents
+            # setting the loop shim currents, all of them in one synced command
+            offset = 4 if withLinGradients else 1
+            currents = []
             for i in range(self.shimInstance.numLoops):
-                current, solution = 0.0, 0.0
-                if withLinGradients:
-                    current = self.solutionValuesToApply[sliceIdx][i+4]
-                    solution = self.solutions[sliceIdx][i+4]
-                else:
-                    current = self.solutionValuesToApply[sliceIdx][i+1]
-                    solution = self.solutions[sliceIdx][i+1]
+                current = self.solutionValuesToApply[sliceIdx][i+offset]
+                solution = self.solutions[sliceIdx][i+offset]
                 self.log(f"DEBUG: Setting currents for loop {i} to {current:.3f}, bc of solution {solution:.3f}")
-                self.sendSyncedShimCurrent(i%8, current)
+                currents.append((i%8, current))
+            if currents:
+                self.sendSyncedShimCurrents(currents)
             if trigger is not None:
                 trigger.finished.emit()
 
@@ -690,18 +712,11 @@ class shimTool():
     def doShimmedScans(self, idx, trigger:Trigger=None):
         self.queueBasisPairScan(preset=True)
         self.shimmedB0Map = None
-        self.exsiInstance.images_ready_event.clear()
-        if self.countScansCompleted(2):
+        def onDone():
             self.computeShimmedB0Map(idx)
             self.evaluateShimImages()
-            if trigger is not None:
-                trigger.success = True
-        else:
-            self.log("Error: Scans didn't complete")
-            self.exsiInstance.images_ready_event.clear()
-            self.exsiInstance.ready_event.clear()
-        if trigger is not None:
-            trigger.finished.emit()
+            return True
+        self.runScanBatch(2, onDone, trigger)
 
 
     @requireExsiConnection
@@ -731,17 +746,11 @@ class shimTool():
         kickoff_thread(queueAll)
 
         self.shimInstance.shimZero()
-        self.exsiInstance.images_ready_event.clear()
         num_scans = (self.shimInstance.numLoops + (4 if withLinGradients else 0)) * 2
-        if self.countScansCompleted(num_scans):
+        def onDone():
             self.log("DEBUG: just finished all the shim eval scans")
             self.evaluateAppliedShims(sliceIdx)
-        else:
-            self.log("Error: Scans didn't complete")
-            self.exsiInstance.images_ready_event.clear()
-            self.exsiInstance.ready_event.clear()
-        if trigger:
-            trigger.finished.emit()
+        self.runScanBatch(num_scans, onDone, trigger)
 
 
     @requireExsiConnection
@@ -771,7 +780,7 @@ class shimTool():
 
 
         self.log(f"DEBUG: Starting at index {startIdx} and doing {numindex} B0MAPS")
-        self.exsiInstance.images_ready_event.clear()
+        self.exsiInstance.clear_images_ready()
         
         def queueAll():
             for i in range(startIdx, startIdx + numindex):
@@ -781,25 +790,53 @@ class shimTool():
                 self.queueBasisPairScan(preset=True)
         kickoff_thread(queueAll)
 
+        # the b0maps are computed by one thread while the next slices get scanned and transferred;
+        # each slice is handed the oldest scan pair no earlier slice has claimed, since the next
+        # slice's series may already have been transferred by the time this one is queued
+        computeQueue = queue.Queue()
+        def computeAll():
+            while True:
+                job = computeQueue.get()
+                if job is None:
+                    return
+                idx, seriesPaths = job
+                try:
+                    self.computeShimmedB0Map(idx, seriesPaths)
+                    self.evaluateShimImages()
+                except Exception as e:
+                    # one bad slice must not stop the worker, the later ones are still queued
+                    self.log(f"ERROR: Failed to compute the shimmed b0map for slice {idx}: {e}")
+                finally:
+                    if trigger is not None:
+                        trigger.finished.emit()
+        kickoff_thread(computeAll)
+
+        claimedSeries = set(listSubDirs(self.localExamRootDir))
+
         for idx in range(startIdx, startIdx+numindex):
-            self.log(f"-------------------------------------------------------------")
-            self.log(f"DEBUG: STARTING B0MAP {idx-startIdx+1} / {numindex}; slice {idx}")
-            self.log(f"DEBUG: solutions for this slice are {self.solutions[idx]}")
-            self.log(f"DEBUG: applied values for this slice are {self.solutionValuesToApply[idx]}")
-            
-            self.log(f"DEBUG: now waiting to actually perform the slice")
+            # one log call for the whole per-slice banner
+            self.log("\n".join([f"-------------------------------------------------------------",
+                                f"DEBUG: STARTING B0MAP {idx-startIdx+1} / {numindex}; slice {idx}",
+                                f"DEBUG: solutions for this slice are {self.solutions[idx]}",
+                                f"DEBUG: applied values for this slice are {self.solutionValuesToApply[idx]}",
+                                f"DEBUG: now waiting to actually perform the slice"]))
             if self.countScansCompleted(2):
-                # perform the rest of these functions in another thread so that the shim setting doesn't lag behind too much
-                def updateVals():
-                    self.computeShimmedB0Map(idx)
-                    self.evaluateShimImages()
+                # scans run in order, so this slice's pair is the two oldest unclaimed series
+                seriesPaths = [d for d in listSubDirs(self.localExamRootDir) if d not in claimedSeries][:2]
+                claimedSeries.update(seriesPaths)
+                if len(seriesPaths) == 2:
+                    computeQueue.put((idx, seriesPaths))
+                else:
+                    self.log(f"Error: Expected 2 new series for slice {idx}, found {len(seriesPaths)}")
                     if trigger is not None:
                         trigger.finished.emit()
-                kickoff_thread(updateVals)
             else:
                 self.log("Error: Scans didn't complete")
-                self.exsiInstance.images_ready_event.clear()
+                # whatever the failed pair left behind must not be taken for the next slice's
+                claimedSeries.update(listSubDirs(self.localExamRootDir))
+                self.exsiInstance.clear_images_ready()
                 self.exsiInstance.ready_event.clear()
+        computeQueue.put(None)
 
 
     def saveResults(self):
@@ -830,24 +867,32 @@ class shimTool():
             refs = [self.backgroundB0Map, 
                     self.expectedB0Map, 
                     self.shimmedB0Map]
+            # float32 nan volumes with only the voxels inside the final mask copied in, float32 is also what gets saved
+            def maskedCopy(volume):
+                masked = np.full(volume.shape, np.nan, dtype=np.float32)
+                np.copyto(masked, volume, where=self.finalMask, casting='same_kind')
+                return masked
+            # largest magnitude of a masked volume, fmax/fmin skip the nans without an np.abs temporary
+            def maxAbs(volume):
+                return max(np.fmax.reduce(volume, axis=None), -np.fmin.reduce(volume, axis=None))
+
             for i in range(3):
                 if refs[i] is not None:
-                    data.append(np.copy(refs[i]))
+                    data.append(maskedCopy(refs[i]))
                     lastNotNone = i
-                    data[i][~self.finalMask] = np.nan
-                    vmax = max(vmax, np.nanmax(np.abs(data[i])))
+                    vmax = max(vmax, maxAbs(data[i]))
 
             data = data[:lastNotNone+1] # only save data that has been collected so far (PRUNE THE NONEs)
 
-            for i in range(len(bases)): 
-                if self.basisB0maps[i] is not None:
-                    bases.append(np.copy(self.basisB0maps))
-                    lastNotNone = i
-                    bases[i][~self.finalMask] = np.nan
-                    vmax = max(vmax, np.nanmax(np.abs(bases[i])))
-            
-            bases = bases[:lastNotNone+1] # only save basismaps that have been collected so far (PRUNE THE NONEs)
+            # only save basismaps that have been collected so far
+            for basis in self.basisB0maps:
+                if basis is not None:
+                    bases.append(maskedCopy(basis))
+                    vmax = max(vmax, maxAbs(bases[-1]))
 
+            # the figures are rendered and encoded in parallel, every worker draws onto its own Agg canvases
+            pool = self.renderPool
+            jobs = []
             # save individual images and stats
             for i in range(len(data)):
                 imageTypeSaveDir = os.path.join(self.resultsDir, labels[i])
@@ -858,11 +903,12 @@ class shimTool():
                         os.makedirs(d)
 
                 self.log(f"Saving slice images and histograms for {labels[i]}")
+                hasData = ~np.isnan(data[i]).all(axis=(0, 2)) # one pass for all slices
                 for j in range(data[0].shape[1]):
                     # save a perslice B0Map image and histogram
-                    if not np.isnan(data[i][:,j,:]).all():
-                        saveImage(imagesDir, labels[i], data[i][:,j,:], j, vmax)
-                        saveHistogram(histDir, labels[i], data[i][:,j,:], j)
+                    if hasData[j]:
+                        jobs.append(pool.submit(saveImage, imagesDir, labels[i], data[i][:,j,:], j, vmax))
+                        jobs.append(pool.submit(saveHistogram, histDir, labels[i], data[i][:,j,:], j))
                 
                 self.log(f"Saving stats for {labels[i]}")
                 # save all the slicewise stats, appended into one file
@@ -873,7 +919,7 @@ class shimTool():
 
                 self.log(f"Saving volume stats for {labels[i]}")
                 # save volume wise histogram 
-                saveHistogram(imageTypeSaveDir, labels[i], data[i], -1)
+                jobs.append(pool.submit(saveHistogram, imageTypeSaveDir, labels[i], data[i], -1))
             
             for i in range(len(bases)):
                 if bases[i] is not None:
@@ -882,28 +928,38 @@ class shimTool():
                     for d in [basesDir, baseDir]:
                         if not os.path.exists(d):
                             os.makedirs(d)
+                    hasData = ~np.isnan(bases[i]).all(axis=(0, 2))
                     for j in range(bases[i].shape[1]):
-                        if not np.isnan(bases[i][:,j,:]).all():
-                            saveImage(baseDir, f"basis{i}", bases[i][:,j,:], j, vmax)
+                        if hasData[j]:
+                            jobs.append(pool.submit(saveImage, baseDir, f"basis{i}", bases[i][:,j,:], j, vmax))
             
             # save the histogram  all images overlayed
             if len(data) >= 2:
                 self.log(f"Saving overlayed volume stats for ROI")
                 data = np.array(data)
                 # for the volume entirely
-                saveHistogramsOverlayed(self.resultsDir, labels, data, -1)
+                jobs.append(pool.submit(saveHistogramsOverlayed, self.resultsDir, labels, data, -1))
                 # for each slice independently
                 overlayHistogramDir = os.path.join(self.resultsDir, 'overlayedHistogramPerSlice')
                 if not os.path.exists(overlayHistogramDir):
                     os.makedirs(overlayHistogramDir)
+                hasData = ~np.isnan(data[0]).all(axis=(0, 2))
                 for j in range(data[0].shape[1]):
-                    if not np.isnan(data[0][:,j,:]).all():
-                        saveHistogramsOverlayed(overlayHistogramDir, labels, data[:,:,j,:], j)
-            
-            # save the numpy data
-            np.save(os.path.join(self.resultsDir, 'shimData.npy'), data)
-            
-            np.save(os.path.join(self.resultsDir, 'basis.npy'), bases)
+                    if hasData[j]:
+                        jobs.append(pool.submit(saveHistogramsOverlayed, overlayHistogramDir, labels, data[:,:,j,:], j))
+
+            # surface any exception raised while saving
+            for job in jobs:
+                job.result()
+
+            # save the numpy data, float32 is plenty for maps in Hz and the masked out nans compress away
+            shimStats = np.empty(len(self.shimStats), dtype=object)
+            for i, statVals in enumerate(self.shimStats):
+                shimStats[i] = statVals
+            np.savez_compressed(os.path.join(self.resultsDir, 'results.npz'),
+                                data=np.asarray(data, dtype=np.float32),
+                                stats=shimStats,
+                                basis=np.asarray(bases, dtype=np.float32))
             self.log(f"Done saving results to {self.resultsDir}")
         kickoff_thread(helper)
 
@@ -6,6 +6,10 @@ from datetime import datetime
 
 from shimTool.utils import launchInThread
 
+# current setting command sent to the arduino, and its confirmation reply
+SENT_CURRENT_PATTERN = re.compile(r"X\s(\d+)\s(\d+)\s(\d+\.\d+)")
+RECEIVED_CURRENT_PATTERN = re.compile(r"board:\s(\d+);\schannel:\s(\d+);\svalue:\s(\d+\.\d+)")
+
 class shim:
     def __init__(self, config, outputFile, defaultTimeout=1, debugging=False):
         self.debugging = debugging
@@ -21,6 +25,7 @@ class shim:
         self.readThread = None
         self.running = None
         self.lastCommand = ""
+        self.lastExpectedCurrent = None # (board, channel, "current:.2f") parsed from the last X command
 
         # TODO: add a way to set the num loops and update the arduino code to accept those changes
         self.numLoops = 0
@@ -29,6 +34,8 @@ class shim:
 
         # this gets set in the Exsi Gui
         self.clearExsiQueue = lambda : None
+        # called from the connection thread once calibrated; set by the shimTool
+        self.onConnected = lambda : None
 
         # Clear the Log
         with open(self.outputFile, "w"):
@@ -50,6 +57,7 @@ class shim:
             if not self.readyEvent.is_set():
                 self.readyEvent.wait()
             self.connectedEvent.set()
+            self.onConnected()
             print(f"INFO SHIM CLIENT: Connection Created successfully")
         t = threading.Thread(target=waitForConnection)
         t.daemon = True 
@@ -147,24 +155,17 @@ class shim:
                 ready = True
 
             # update our record of loop current and verify it got ingested as expected
-            rec_pattern = r"board:\s(\d+);\schannel:\s(\d+);\svalue:\s(\d+\.\d+)"
-            sent_pattern = r"X\s(\d+)\s(\d+)\s(\d+\.\d+)"
-            match = re.search(rec_pattern, msg)
+            match = RECEIVED_CURRENT_PATTERN.search(msg)
             if match:
                 board = int(match.group(1))
                 channel = int(match.group(2))
                 current = float(match.group(3))
-                
-                expected = re.search(sent_pattern, self.lastCommand)
-                expBoard = int(expected.group(1))
-                expChannel = int(expected.group(2))
-                expCurrent = float(expected.group(3))
-                if (expBoard != board) or \
-                    (expChannel != channel) or \
-                    (f"{current:.2f}" != f"{expCurrent:.2f}"):
+
+                if self.lastExpectedCurrent is None or \
+                    self.lastExpectedCurrent != (board, channel, f"{current:.2f}"):
                     fail = True
                     print(f"Debug: Failed Command Mismatch in current setting:")
-                    print(f"\tExpected:\t{expBoard}, {expChannel}, {expCurrent:.2f}")
+                    print(f"\tExpected:\t{self.lastExpectedCurrent}")
                     print(f"\tGot:\t{board}, {channel}, {current:.2f}")
                 else:
                     # TODO(rob): maybe add some error bounds checking for indexing this guy
@@ -194,6 +195,11 @@ class shim:
     def _sendCommand(self, cmd):
         if cmd is not None:
             self.lastCommand = cmd
+            # parse what the arduino should echo back once, instead of for every line it replies with
+            self.lastExpectedCurrent = None
+            expected = SENT_CURRENT_PATTERN.search(cmd)
+            if expected:
+                self.lastExpectedCurrent = (int(expected.group(1)), int(expected.group(2)), f"{float(expected.group(3)):.2f}")
             self.readyEvent.clear()
             self.ser.write(cmd.encode())
 
@@ -233,7 +239,7 @@ class shim:
             if not self.connectedEvent.is_set() and not self.debugging:
                 # Show a message to the user, reconnect shim client.
                 raise ShimDriverError("SHIM Client Not Connected")
-            return func(self)
+            return func(self, *args, **kwargs)
         return wrapper
  
     @launchInThread
@@ -258,6 +264,15 @@ class shim:
         """helper function to set the current for a specific channel on a specific board."""
         self.send(f"X {board} {channel} {current}")
 
+    @launchInThread
+    @requireShimDriverConnected
+    def shimSetCurrentsManual(self, currents, board=0):
+        """helper function to set the currents of several channels on a specific board with one call.
+        currents is a list of (channel, current) pairs; they are queued back to back and in order from one thread.
+        The arduino firmware still takes one channel per X command."""
+        for channel, current in currents:
+            self.send(f"X {board} {channel} {current}")
+
 class ShimDriverError(Exception):
     """Exception raised for errors in the Shim Driver."""
     pass
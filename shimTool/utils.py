@@ -1,29 +1,86 @@
-import threading, os, json
-from matplotlib import pyplot as plt
-import paramiko, subprocess, os, threading, re
+import threading, os, json, queue, atexit
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import paramiko, subprocess, os, threading, re, stat
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import numpy as np
 
 from shimTool.guiUtils import *
 
+# linear shim values in the Gradient.log line of the last successful prescan
+GRADIENT_PATTERN = re.compile(r'X =\s+(-?\d+)\s+Y =\s+(-?\d+)\s+Z =\s+(-?\d+)')
+
 def load_config(filename):
     with open(filename, 'r') as file:
         return json.load(file)
 
+# log lines are handed to one writer thread, which keeps the file open and flushes once the queue runs dry
+logQueue = queue.SimpleQueue()
+logWriterLock = threading.Lock()
+logWriter = None
+# resolved against the repo root (what the config rootDir points at) rather than the cwd; the shimTool sets the configured guiLog
+logPath = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "logs", "guiLog.txt")
+
+def writeLogLines(file):
+    with file:
+        while True:
+            line = logQueue.get()
+            while line is not None:
+                file.write(line)
+                try:
+                    line = logQueue.get_nowait()
+                except queue.Empty:
+                    break
+            file.flush()
+            if line is None:
+                return
+
+def startLogWriter():
+    """Open the log file in the calling thread, so a bad path raises right there, then hand it to the writer thread."""
+    global logWriter
+    os.makedirs(os.path.dirname(logPath), exist_ok=True)
+    file = open(logPath, 'a', buffering=1 << 16)
+    logWriter = threading.Thread(target=writeLogLines, args=(file,), daemon=True)
+    logWriter.start()
+
+def stopLogWriter():
+    # let the writer finish what is queued before the interpreter goes away
+    writer = logWriter
+    if writer is not None and writer.is_alive():
+        logQueue.put(None)
+        writer.join(timeout=2)
+
+atexit.register(stopLogWriter)
+
+def setLogPath(path):
+    """Write the log to path from now on, finishing the lines queued for the previous file first."""
+    global logPath, logWriter
+    with logWriterLock:
+        stopLogWriter()
+        logWriter = None
+        logPath = path
+
 def log(msg, stdout=False):
     # record a timestamp and prepend to the message
     # TODO
     # base log function that every class uses to log to std out and maybe the guiLog? idk, this should be revisited....
-    guilog = "logs/guiLog.txt"
     current_time = datetime.now()
     formatted_time = current_time.strftime('%H:%M:%S')
     msg = f"{formatted_time} {msg}"
     # only print if in debugging mode, or if forceStdOut is set to True
     if stdout:
         print(msg)
-    # always write to the log file
-    with open(guilog, 'a') as file:
-        file.write(f"{msg}\n")
+    # always write to the log file, through the writer thread started on first use
+    writer = logWriter
+    if writer is None:
+        with logWriterLock:
+            if logWriter is None:
+                startLogWriter()
+            writer = logWriter
+    # a writer that has exited takes no more lines, instead of letting them pile up in the queue
+    if writer.is_alive():
+        logQueue.put(f"{msg}\n")
 
 def kickoff_thread(target, args=()):
     t = threading.Thread(target=target, args=args)
@@ -36,6 +93,24 @@ def launchInThread(func):
         kickoff_thread(func, (self, *args))
     return wrapper
 
+# figures kept per thread and per figsize, so that saving many images does not rebuild a figure every time
+threadFigures = threading.local()
+
+def getThreadFigure(figsize=None):
+    """Get a cleared figure with one axes, rendered straight onto its own Agg canvas.
+    Unlike pyplot, nothing is registered globally, so figures can be drawn and saved from worker threads.
+    The figure belongs to the calling thread and is handed out again by its next call, so save it before that."""
+    if not hasattr(threadFigures, "bySize"):
+        threadFigures.bySize = {}
+    fig = threadFigures.bySize.get(figsize)
+    if fig is None:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+        threadFigures.bySize[figsize] = fig
+    else:
+        fig.clear()
+    return fig, fig.add_subplot()
+
 def saveImage(directory, title, b0map, slice_index, vmax, white=False):
     """Save B0MAP of either background, estimation, or actual to a file."""
 
@@ -44,24 +119,19 @@ def saveImage(directory, title, b0map, slice_index, vmax, white=False):
     name = f"{title} B0 Map Slice:{slice_index} (Hz)"
     output_path = os.path.join(directory, f"{title}_{slice_index}"+".png")
 
-    fig, ax = plt.subplots(figsize=(8, 6))
+    fig, ax = getThreadFigure(figsize=(8, 6))
     im = ax.imshow(b0map, cmap='jet', vmin=-vmax, vmax=vmax)
-    cbar = plt.colorbar(im)
-
-    if white:
-        # Set colorbar tick labels to white
-        cbar.ax.yaxis.set_tick_params(color='white')
-        # Set the color of the tick labels to white
-        plt.setp(plt.getp(cbar.ax.axes, 'yticklabels'), color='white')
+    cbar = fig.colorbar(im, ax=ax)
 
     if white:
-        plt.title(name, color='white', size=10)
+        # Set colorbar ticks and their labels to white
+        cbar.ax.yaxis.set_tick_params(color='white', labelcolor='white')
+        ax.set_title(name, color='white', size=10)
     else:
-        plt.title(name, size=10)
-    plt.axis('off')
+        ax.set_title(name, size=10)
+    ax.axis('off')
     
     fig.savefig(output_path, bbox_inches='tight', transparent=white)
-    plt.close(fig)
     return output_path
 
 def saveStats(directory, title, stats, volume=False):
@@ -85,7 +155,7 @@ def saveStats(directory, title, stats, volume=False):
 
 def saveHistogram(directory, title, data, slice_index):
     """Save a histogram of the data of either background, estimation, actual at slice or over Full ROI to a file."""
-    fig, ax = plt.subplots()
+    fig, ax = getThreadFigure()
     flatdata = data.flatten()
     #ignore nans:
     flatdata = flatdata[~np.isnan(flatdata)]
@@ -101,12 +171,11 @@ def saveHistogram(directory, title, data, slice_index):
         output_path = os.path.join(directory, f"{title}_Volume_Histogram.png")
  
     fig.savefig(output_path, bbox_inches='tight', transparent=False)
-    plt.close(fig)
     return output_path
 
 def saveHistogramsOverlayed(directory, titles, data, slice_index):
     """Save a histogram of the data of background, estimation, actual overlayed at slice or over Full ROI to a file."""
-    fig, ax = plt.subplots()
+    fig, ax = getThreadFigure()
     print(F"UTILS debug: saving histogram overlayed with data shape: {data.shape}, index: {slice_index}")
     if data.shape[0] == 3 or data.shape[0] == 2: # either background and est ; or back, est, and actual
         for i in range(data.shape[0]):
@@ -126,40 +195,93 @@ def saveHistogramsOverlayed(directory, titles, data, slice_index):
         ax.set_title("Offresonance Over Full ROI")
         output_path = os.path.join(directory, f"overlayed_histograms_Volume.png")
     fig.savefig(output_path, bbox_inches='tight', transparent=False)
-    plt.close(fig)
     return output_path
 
     ##### OTHER METHODS ######
 
+# one ssh connection per (host, port, user), opened on first use and shared by all the exec helpers
+sshClients = {}
+sshLock = threading.Lock()
+
+def getSSHClient(host, hvPort, hvUser, hvPassword):
+    """Return the cached connected ssh client, (re)connecting if there is none or its transport died."""
+    key = (host, hvPort, hvUser)
+    with sshLock:
+        client = sshClients.get(key)
+        transport = client.get_transport() if client is not None else None
+        if transport is None or not transport.is_active():
+            if client is not None:
+                client.close()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # Automatically add host key
+            client.connect(hostname=host, port=hvPort, username=hvUser, password=hvPassword)
+            client.get_transport().set_keepalive(30) # keep it alive through the idle time between scans
+            sshClients[key] = client
+        return client
+
+def dropSSHClient(host, hvPort, hvUser):
+    """Close and forget the cached ssh client, so the next call reconnects."""
+    with sshLock:
+        client = sshClients.pop((host, hvPort, hvUser), None)
+    if client is not None:
+        client.close()
+
 def execSSHCommand(host, hvPort, hvUser, hvPassword, command):
-    # Initialize the SSH client
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # Automatically add host key
     try:
-        client.connect(hostname=host, port=hvPort, username=hvUser, password=hvPassword)
+        client = getSSHClient(host, hvPort, hvUser, hvPassword)
         stdin, stdout, stderr = client.exec_command(command)
         return stdout.readlines()  # Read the output of the command
 
     except Exception as e:
         print(f"Connection or command execution failed: {e}")
-    finally:
-        client.close()
+        dropSSHClient(host, hvPort, hvUser)
 
-def execRsyncCommand(hvPass, hvUser, host, source, destination):
-    # Construct the SCP command using sshpass
-    cmd = f"sshpass -p {hvPass} rsync -avz {hvUser}@{host}:{source} {destination}"
+def execSFTPSync(host, hvPort, hvUser, hvPassword, source, destination, workers=8):
+    """Mirror the remote source directory into destination over the shared ssh connection.
+    Files already present locally with the same size are skipped, the rest are fetched in parallel."""
+    sftpClients = []
+    try:
+        transport = getSSHClient(host, hvPort, hvUser, hvPassword).get_transport()
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        sftpClients.append(sftp)
 
-    # Execute the SCP command
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # Wait for the command to complete
-    stdout, stderr = process.communicate()
-    
-    # Check if the command was executed successfully
-    if process.returncode == 0:
-        return stdout.decode('utf-8')
-    else:
-        return f"Error: {stderr.decode('utf-8')}"
+        # walk the remote tree once, collecting the files that still need to come over
+        toFetch = []
+        remoteDirs = [source]
+        while remoteDirs:
+            remoteDir = remoteDirs.pop()
+            localDir = os.path.normpath(os.path.join(destination, os.path.relpath(remoteDir, source)))
+            os.makedirs(localDir, exist_ok=True)
+            for attr in sftp.listdir_attr(remoteDir):
+                remotePath = remoteDir + "/" + attr.filename
+                localPath = os.path.join(localDir, attr.filename)
+                if stat.S_ISDIR(attr.st_mode):
+                    remoteDirs.append(remotePath)
+                elif not (os.path.exists(localPath) and os.path.getsize(localPath) == attr.st_size):
+                    toFetch.append((attr.st_size, remotePath, localPath))
+        # largest first, so that one big file does not straggle at the end
+        toFetch.sort(reverse=True)
 
+        # every worker thread gets its own sftp channel on the one shared connection
+        channels = threading.local()
+        def fetch(job):
+            if not hasattr(channels, "sftp"):
+                channels.sftp = paramiko.SFTPClient.from_transport(transport)
+                sftpClients.append(channels.sftp)
+            channels.sftp.get(job[1], job[2])
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(fetch, toFetch):
+                pass
+        return f"Transferred {len(toFetch)} files"
+
+    except Exception as e:
+        dropSSHClient(host, hvPort, hvUser)
+        return f"Error: {e}"
+    finally:
+        # only the sftp channels are closed, the connection stays up for the next call
+        for client in sftpClients:
+            client.close()
 
 def getLastSetGradients(host, hvPort, hvUser, hvPassword):
     # Command to extract the last successful setting of the shim currents
@@ -169,9 +291,9 @@ def getLastSetGradients(host, hvPort, hvUser, hvPassword):
     if output:
         last_line = output[0].strip()
         # Use regex to find X, Y, Z values
-        match = re.search(r'X =\s+(-?\d+)\s+Y =\s+(-?\d+)\s+Z =\s+(-?\d+)', last_line)
+        match = GRADIENT_PATTERN.search(last_line)
         if match:
-            gradients = [int(match.group(i)) for i in range(1, 4)]
+            gradients = [int(value) for value in match.groups()]
             print(f"UTILS: Debug: found that linear shims got set to {gradients}")
             return np.array(gradients)
         print(f"DEBUG: no matches!")
@@ -198,18 +320,3 @@ def execBashCommand(cmd):
         return stdout.decode('utf-8')
     else:
         return f"Error: {stderr.decode('utf-8')}"
-
-def execSCPCommand(hvPass, hvUser, hvHost, source, destination):
-    # Construct the SCP command using sshpass
-    cmd = f"sshpass -p {hvPass} scp -r {hvUser}@{hvHost}:{source} {destination}"
-
-    # Execute the SCP command
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    # Wait for the command to complete
-    stdout, stderr = process.communicate()
-
-    # Check if the command was executed successfully
-    if process.returncode == 0:
-        return stdout.decode('utf-8')
-    else:
-        return f"Error: {stderr.decode('utf-8')}"
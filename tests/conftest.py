@@ -0,0 +1,5 @@
+import os
+import sys
+
+# import the modules as the shimTool package, the way they import each other
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
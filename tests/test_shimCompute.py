@@ -0,0 +1,38 @@
+import os
+import numpy as np
+import pytest
+
+shimCompute = pytest.importorskip("shimTool.shimCompute")
+
+
+def fakeExam(tmp_path, monkeypatch):
+    """Exam directory with one basis pair, whose b0 map comes out as all 5s"""
+    for name in ("s1", "s2"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(shimCompute, "extractComplexImageData",
+                        lambda path, threshFactor: (np.ones((2, 3, 4)), 1.0, os.path.basename(path)))
+    monkeypatch.setattr(shimCompute, "compute_b0map", lambda first, second, te1, te2: np.full((2, 3, 4), 5.0))
+    return str(tmp_path)
+
+
+def cachedStackPath(examDir):
+    return [os.path.join(examDir, name) for name in os.listdir(examDir) if name.endswith(".npy")][0]
+
+
+def test_compute_b0maps_result_does_not_write_back_to_cache(tmp_path, monkeypatch):
+    examDir = fakeExam(tmp_path, monkeypatch)
+    b0maps = shimCompute.compute_b0maps(1, examDir)
+
+    with pytest.raises(ValueError):
+        b0maps[0] += 1
+    np.testing.assert_array_equal(np.load(cachedStackPath(examDir)), np.full((1, 2, 3, 4), 5.0))
+
+
+def test_compute_b0maps_cache_hit_matches_miss(tmp_path, monkeypatch):
+    examDir = fakeExam(tmp_path, monkeypatch)
+    miss = shimCompute.compute_b0maps(1, examDir)
+    hit = shimCompute.compute_b0maps(1, examDir)
+
+    assert type(miss) is type(hit)
+    assert not miss.flags.writeable and not hit.flags.writeable
+    np.testing.assert_array_equal(miss, hit)
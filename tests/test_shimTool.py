@@ -0,0 +1,17 @@
+import pytest
+
+shimToolModule = pytest.importorskip("shimTool.shimTool")
+from shimTool.utils import setLogPath
+
+
+def test_shimTool_log_writes_to_the_gui_log(tmp_path):
+    logPath = tmp_path / "guiLog.txt"
+    setLogPath(str(logPath))
+    # log only needs the debugging flag, skip the constructor that connects to the scanner and the arduino
+    tool = shimToolModule.shimTool.__new__(shimToolModule.shimTool)
+    tool.debugging = False
+
+    tool.log("hello")
+    setLogPath(str(tmp_path / "other.txt")) # finishes the writer of the first file
+
+    assert logPath.read_text().endswith("SHIM TOOL: hello\n")
@@ -0,0 +1,41 @@
+import os
+import stat
+from types import SimpleNamespace
+import pytest
+
+utils = pytest.importorskip("shimTool.utils")
+
+
+class FakeSFTP:
+    """Serves a flat remote directory of {name: bytes}, recording every file that gets pulled"""
+    def __init__(self, files, fetched):
+        self.files = files
+        self.fetched = fetched
+
+    def listdir_attr(self, path):
+        return [SimpleNamespace(filename=name, st_mode=stat.S_IFREG | 0o644, st_size=len(data))
+                for name, data in self.files.items()]
+
+    def get(self, remotePath, localPath):
+        self.fetched.append(remotePath)
+        with open(localPath, "wb") as file:
+            file.write(self.files[os.path.basename(remotePath)])
+
+    def close(self):
+        pass
+
+
+def test_execSFTPSync_skips_files_of_equal_size(tmp_path, monkeypatch):
+    remoteFiles = {"same.dcm": b"abc", "changed.dcm": b"abcde"}
+    fetched = []
+    monkeypatch.setattr(utils, "getSSHClient", lambda *args: SimpleNamespace(get_transport=lambda: None))
+    monkeypatch.setattr(utils.paramiko.SFTPClient, "from_transport", lambda transport: FakeSFTP(remoteFiles, fetched))
+    (tmp_path / "same.dcm").write_bytes(b"xyz") # same size as the remote one
+    (tmp_path / "changed.dcm").write_bytes(b"ab") # different size
+
+    result = utils.execSFTPSync("host", 22, "user", "pass", "/remote", str(tmp_path))
+
+    assert fetched == ["/remote/changed.dcm"]
+    assert result == "Transferred 1 files"
+    assert (tmp_path / "same.dcm").read_bytes() == b"xyz"
+    assert (tmp_path / "changed.dcm").read_bytes() == b"abcde"